@@ -0,0 +1,48 @@
+"""
+Throughput of every digest algorithm selectable with --hash/--filter-hash.
+
+    python -m benchmarks.bench_digest [size_mb] [rounds]
+
+The file is hashed once before timing, so the numbers measure the digest
+rather than the disk.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from dedup.context import ctx
+from dedup.reader import ALGORITHMS, FileReader
+
+
+def measure(algorithm, filename, size, rounds):
+    FileReader._hash_full_file(filename, algorithm)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        FileReader._hash_full_file(filename, algorithm)
+    elapsed = time.perf_counter() - start
+    return size * rounds / elapsed / 1024 / 1024
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    size = size_mb * 1024 * 1024
+    ctx.use_mmap = False
+
+    with tempfile.NamedTemporaryFile(delete=False) as fo:
+        for _ in range(size_mb):
+            fo.write(os.urandom(1024 * 1024))
+        filename = fo.name
+    try:
+        for algorithm in ALGORITHMS:
+            print(
+                f"{algorithm:8} {measure(algorithm, filename, size, rounds):8.1f} MB/s"
+            )
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
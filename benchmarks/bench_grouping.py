@@ -0,0 +1,61 @@
+"""
+Size grouping of _duplicates: spillable dict grouping against NumPy columns.
+
+    python -m benchmarks.bench_grouping [files]
+
+Records are synthesized, nothing touches the disk. Needs numpy.
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from dedup.context import ctx
+from dedup.processor import Processor
+from dedup.reader import File
+
+
+def make_files(count):
+    rng = random.Random(0)
+    files = {}
+    for i in range(count):
+        directory = f"/data/d{i // 1000:05}"
+        file_obj = File(f"{directory}/f{i:07}", directory)
+        file_obj.size = rng.randrange(count * 4)
+        file_obj.mtime_ns = 0
+        file_obj.dev = 1
+        file_obj.ino = i + 1
+        file_obj.nlink = 1
+        files[file_obj.filename] = file_obj
+    return files
+
+
+def measure(processor, files, columnar):
+    ctx.columnar = columnar
+    start = time.perf_counter()
+    groups = list(processor._size_groups(files))
+    elapsed = time.perf_counter() - start
+    # tracing slows the run down, measure memory in a second one
+    tracemalloc.start()
+    list(processor._size_groups(files))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, groups
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    files = make_files(count)
+    processor = Processor([])
+
+    results = {}
+    for name, columnar in [("dict", False), ("numpy", True)]:
+        elapsed, peak, groups = measure(processor, files, columnar)
+        results[name] = groups
+        print(f"{name:6} {elapsed:6.2f}s  peak {peak:8.1f} MB  {len(groups)} groups")
+    assert results["dict"] == results["numpy"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Page cache left behind by hashing, with and without --gentle-io.
+
+    python -m benchmarks.bench_page_cache [files] [size_mb]
+
+Files are evicted before each run, the "Cached" line of /proc/meminfo is
+read before and after hashing them all. Linux only.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from dedup.context import ctx
+from dedup.reader import FileReader
+
+
+def cached_mb():
+    with open("/proc/meminfo") as fi:
+        for line in fi:
+            if line.startswith("Cached:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("no Cached line in /proc/meminfo")
+
+
+def evict(filenames):
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run(filenames, gentle_io):
+    ctx.gentle_io = gentle_io
+    evict(filenames)
+    before = cached_mb()
+    start = time.perf_counter()
+    for filename in filenames:
+        FileReader._hash_full_file(filename)
+    elapsed = time.perf_counter() - start
+    return cached_mb() - before, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = []
+        for i in range(count):
+            filename = os.path.join(directory, f"file{i}")
+            with open(filename, "wb") as fo:
+                for _ in range(size_mb):
+                    fo.write(os.urandom(1024 * 1024))
+                fo.flush()
+                os.fsync(fo.fileno())
+            filenames.append(filename)
+
+        total = count * size_mb
+        for name, gentle_io in [("default", False), ("gentle-io", True)]:
+            grown, elapsed = run(filenames, gentle_io)
+            print(
+                f"{name:10} page cache {grown:+8.1f} MB of {total} MB hashed, "
+                f"{total / elapsed:8.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Hashing throughput of FileReader against the previous read()-per-chunk loop.
+
+    python -m benchmarks.bench_reader [size_mb] [rounds]
+
+The file is hashed once before timing, so numbers are for a warm page cache,
+which is where per-read allocations show up most.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from hashlib import md5
+
+from dedup.context import ctx
+from dedup.reader import FileReader
+
+
+def legacy_hash(filename):
+    m = md5()
+    with open(filename, "rb") as fi:
+        while chunk := fi.read(64 * 1024):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def reader_hash(filename):
+    return FileReader._hash_full_file(filename)
+
+
+def mmap_hash(filename):
+    ctx.use_mmap = True
+    try:
+        return FileReader._hash_full_file(filename)
+    finally:
+        ctx.use_mmap = False
+
+
+def measure(func, filename, size, rounds):
+    func(filename)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(filename)
+    elapsed = time.perf_counter() - start
+    return size * rounds / elapsed / 1024 / 1024
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    size = size_mb * 1024 * 1024
+    ctx.mmap_threshold = 0
+
+    with tempfile.NamedTemporaryFile(delete=False) as fo:
+        for _ in range(size_mb):
+            fo.write(os.urandom(1024 * 1024))
+        filename = fo.name
+    try:
+        assert legacy_hash(filename) == reader_hash(filename) == mmap_hash(filename)
+        for name, func in [
+            ("read() 64KB", legacy_hash),
+            ("readinto", reader_hash),
+            ("mmap", mmap_hash),
+        ]:
+            print(f"{name:12} {measure(func, filename, size, rounds):8.1f} MB/s")
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
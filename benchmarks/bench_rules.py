@@ -0,0 +1,65 @@
+"""
+Appraiser rule weights: the startswith loop over every rule against the
+prefix length index.
+
+    python -m benchmarks.bench_rules [rules] [paths]
+
+Rules look like the directories add_from_file collects over many sessions.
+"""
+
+import os
+import random
+import sys
+import time
+
+from dedup.appraiser import Rules
+
+
+def legacy_weight(rules, filepath):
+    weight = 0
+    for rule in rules:
+        if filepath.startswith(rule):
+            weight += rules[rule]
+        if os.path.dirname(filepath) == rule:
+            weight += rules[rule]
+    return weight
+
+
+def random_dir(rng):
+    parts = ["", "data"] + [
+        f"{rng.choice(['photos', 'video', 'docs', 'backup'])}{rng.randrange(300)}"
+        for _ in range(rng.randrange(1, 6))
+    ]
+    return "/".join(parts)
+
+
+def main():
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    path_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rng = random.Random(0)
+
+    plain = {}
+    rules = Rules()
+    while len(plain) < rule_count:
+        rule = random_dir(rng)
+        plain[rule] = rules[rule] = rng.randrange(1, 5)
+    paths = [f"{random_dir(rng)}/IMG_{i:05}.jpg" for i in range(path_count)]
+
+    start = time.perf_counter()
+    expected = [legacy_weight(plain, path) for path in paths]
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    weights = [rules.weight(path) for path in paths]
+    indexed = time.perf_counter() - start
+
+    assert weights == expected
+    print(f"{len(plain)} rules, {path_count} paths")
+    print(f"startswith loop {legacy:8.3f}s  {legacy / path_count * 1e6:10.1f} us/path")
+    print(
+        f"length index    {indexed:8.3f}s  {indexed / path_count * 1e6:10.1f} us/path"
+    )
+
+
+if __name__ == "__main__":
+    main()
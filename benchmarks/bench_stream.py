@@ -0,0 +1,64 @@
+"""
+Peak Python memory of calculus with and without --stream.
+
+    python -m benchmarks.bench_stream [files]
+
+The tree holds files of distinct sizes plus a few duplicate pairs, the
+case where streaming keeps memory flat. Peaks are measured with tracemalloc.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dedup.context import ctx
+from dedup.processor import Processor
+
+
+def make_tree(root, count):
+    for d in range(count // 1000 + 1):
+        directory = os.path.join(root, f"d{d:04}")
+        os.makedirs(directory)
+        for i in range(min(1000, count - d * 1000)):
+            with open(os.path.join(directory, f"f{i:04}"), "wb") as fo:
+                fo.write(b"x" * (d * 1000 + i + 1))
+    for i in range(10):
+        for copy in ("a", "b"):
+            with open(os.path.join(root, f"dup{i}{copy}"), "wb") as fo:
+                fo.write(b"dup %d" % i + b" " * 10**7)
+
+
+def measure(root, stream):
+    ctx.stream = stream
+    tracemalloc.start()
+    start = time.perf_counter()
+    files, dups = Processor([root]).calculus()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, elapsed, len(dups)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    ctx.dry_run = True
+    ctx.jobs = 1
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, count)
+        cwd = os.getcwd()
+        os.chdir(root)  # progress file
+        try:
+            for name, stream in [("in memory", False), ("stream", True)]:
+                peak, elapsed, groups = measure(root, stream)
+                print(
+                    f"{name:10} peak {peak:8.1f} MB  {elapsed:6.2f}s  {groups} groups"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,148 @@
+import bisect
 import os
-from typing import List, Tuple
-from collections import defaultdict
+import re
+from typing import Dict, Iterable, List, Tuple
+from collections import Counter, defaultdict
 
 from . import logger
 
 from .context import ctx
+from .journal import journal, replay
 from .misc import to_abs
+from .paths import files as paths
+
+FileId = int
+
+
+class Rules(dict):
+    """Rule weights by path prefix, missing rules weigh 0.
+
+    Rules are plain string prefixes, a rule may end inside a path component.
+    They are indexed by length, so weighing a path looks up one prefix per
+    distinct rule length instead of calling startswith for every rule.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lengths = Counter()
+        self._sorted_lengths: List[int] = []
+
+    def __missing__(self, key):
+        return 0
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._lengths[len(key)] += 1
+            if self._lengths[len(key)] == 1:
+                bisect.insort(self._sorted_lengths, len(key))
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._lengths[len(key)] -= 1
+        if not self._lengths[len(key)]:
+            del self._lengths[len(key)]
+            self._sorted_lengths.remove(len(key))
+
+    def weight(self, filepath: str) -> int:
+        weight = 0
+        for length in self._sorted_lengths:
+            if length > len(filepath):
+                break
+            weight += self.get(filepath[:length], 0)
+        # a rule matching the file directory exactly counts twice
+        return weight + self.get(os.path.dirname(filepath), 0)
+
+
+class Matcher:
+    """Ignore/remove list entries compiled for one pass per path.
+
+    substrings become a single regular expression, exact paths a set checked
+    against the path and its ancestors, with the result cached per directory.
+    """
+
+    def __init__(self, exact: Iterable[str] = (), substrings: Iterable[str] = ()):
+        self.exact = set(exact)
+        substrings = sorted(set(substrings), key=len, reverse=True)
+        self._pattern = (
+            re.compile("|".join(map(re.escape, substrings))) if substrings else None
+        )
+        self._dirs: Dict[str, bool] = {}
+
+    def contains(self, path: str) -> bool:
+        """a substring pattern occurs in path"""
+        return self._pattern is not None and self._pattern.search(path) is not None
+
+    def under(self, path: str) -> bool:
+        """path or one of its ancestors is an exact entry"""
+        if not self.exact:
+            return False
+        if path in self.exact:
+            return True
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return False
+        found = self._dirs.get(parent)
+        if found is None:
+            found = self._dirs[parent] = self.under(parent)
+        return found
 
 
 class Appraiser:
     def __init__(self):
-        self._rules = defaultdict(int)  # file_path: weight
+        self._rules = Rules()  # file_path: weight
         self._answers = set()
         self._ignore = defaultdict(set)
         self._remove = defaultdict(set)
+        self._ignored = Matcher()
+        self._removed = Matcher()
+        self._journaled = 0  # rule changes since the last compaction
         self.reload_rules()
         self.load_answers()
 
     def calc_weight(self, filepath):
         # calculates weight for cpeciefic filepath
-        weight = 0
-        for rule in self._rules:
-            if filepath.startswith(rule):
-                weight += self._rules[rule]
-
-            if os.path.dirname(filepath) == rule:
-                # increase wieght if rule exact match the file directory
-                weight += self._rules[rule]
-        return weight
+        return self._rules.weight(filepath)
 
     def is_ignored(self, file) -> bool:
-        while file:
-            if file in self._ignore["="]:
-                return True
-            for pat in self._ignore["~"]:
-                if pat in file:
-                    return True
-            dirname = os.path.dirname(file)
-            if file == dirname:
-                return False
-            file = dirname
-        return False
+        # a substring of an ancestor is a substring of the path itself
+        return self._ignored.under(file) or self._ignored.contains(file)
 
     def in_remove(self, directory, filename):
         if os.path.basename(filename) in self._remove["f"]:
             return True
-        elif directory in self._remove["d"]:
+        elif directory in self._removed.exact:
             return True
-        for par in self._remove["~"]:
-            if par in filename:
-                return True
-        return False
+        return self._removed.contains(filename)
 
-    def weight(self, files, filter_removed=True):
+    def weight(self, files: List[FileId], filter_removed=True):
         weighted = defaultdict(list)
         leftovers = []
         dirs = set()
-        for filename in files:
-            filename = to_abs(filename)
-            directory = os.path.dirname(filename)
+        for file_id in files:
+            filename = paths.absolute(file_id)
+            directory = paths.directory(file_id)
 
             if filter_removed:
                 if self.in_remove(directory, filename):
-                    leftovers.append(filename)
+                    leftovers.append(file_id)
                     continue
 
             if directory in dirs:
                 # we have already file in this directory
-                leftovers.append(filename)
+                leftovers.append(file_id)
                 continue
             else:
                 dirs.add(directory)
 
-            weighted[self.calc_weight(filename)].append(filename)
+            weighted[self.calc_weight(filename)].append(file_id)
 
         if not weighted:
             weighted, leftovers = self.weight(files, filter_removed=False)
         return weighted, leftovers
 
-    def decide(self, files) -> Tuple[List[str], List[str]]:
-        files = [file for file in files if not self.is_ignored(file)]
+    def decide(self, files: List[FileId]) -> Tuple[List[FileId], List[FileId]]:
+        files = [f for f in files if not self.is_ignored(paths.absolute(f))]
 
         if not files:
             return [], []
@@ -99,25 +162,55 @@ class Appraiser:
 
         return selected, leftovers
 
-    def add_from_file(self, file_path: str):
-        dirname = to_abs(os.path.dirname(file_path))
+    def add_from_file(self, file_id: FileId):
+        dirname = paths.directory(file_id)
         self._rules[dirname] += 1
-        with ctx.appraiser_rules_filename.open(encoding="utf-8", mode="w") as fo:
+        # the new weight, not the increment: replaying twice changes nothing
+        journal.append(ctx.rules_journal_filename, f"{self._rules[dirname]}:{dirname}")
+        self._journaled += 1
+        if self._journaled >= ctx.journal_compact_entries:
+            self.compact_rules()
+
+    def compact_rules(self):
+        """write all rules to the rules file and drop the journal"""
+        if not self._journaled:
+            return
+        tmp_path = f"{ctx.appraiser_rules_filename}.tmp"
+        with open(tmp_path, encoding="utf-8", mode="w") as fo:
             for _path, _weight in self._rules.items():
                 fo.write(f"{_weight}:{_path}\n")
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.replace(tmp_path, ctx.appraiser_rules_filename)
+        journal.discard(ctx.rules_journal_filename)
+        self._journaled = 0
+        logger.debug(f"compacted {len(self._rules)} rules")
 
     def reload_rules(self):
-        self._rules = defaultdict(int)
+        self._rules = Rules()
+        self._journaled = 0
+        journal.sync()
 
-        if ctx.rerun and os.path.exists(ctx.appraiser_rules_filename):
+        if ctx.rerun and (
+            os.path.exists(ctx.appraiser_rules_filename)
+            or os.path.exists(ctx.rules_journal_filename)
+        ):
             logger.debug(f"read rules from {ctx.appraiser_rules_filename}")
-            with ctx.appraiser_rules_filename.open(encoding="utf-8", mode="rt") as fi:
-                for line in fi.readlines():
-                    line = line.strip()
-                    if not line:
-                        continue
-                    _wieght, _path = line.split(":", 1)
-                    self._rules[_path] = int(_wieght)
+            if os.path.exists(ctx.appraiser_rules_filename):
+                with ctx.appraiser_rules_filename.open(
+                    encoding="utf-8", mode="rt"
+                ) as fi:
+                    for line in fi.readlines():
+                        line = line.strip()
+                        if not line:
+                            continue
+                        _wieght, _path = line.split(":", 1)
+                        self._rules[_path] = int(_wieght)
+            # changes of an interrupted session, newer than the rules file
+            for line in replay(ctx.rules_journal_filename):
+                _wieght, _path = line.split(":", 1)
+                self._rules[_path] = int(_wieght)
+                self._journaled += 1
             logger.debug(f"read ignore file from {ctx.appraiser_ignore_filename}")
             self._ignore = defaultdict(set)
             if os.path.exists(ctx.appraiser_ignore_filename):
@@ -152,25 +245,31 @@ class Appraiser:
                         tp, text = line.split(":", 1)
                         self._remove[tp].add(text)
 
+        self._ignored = Matcher(self._ignore["="], self._ignore["~"])
+        self._removed = Matcher(self._remove["d"], self._remove["~"])
+
     def load_answers(self):
         logger.debug(f"read answers file from {ctx.answers_filename}")
         if ctx.rerun and os.path.exists(ctx.answers_filename):
             with ctx.answers_filename.open(encoding="utf-8", mode="rt") as fi:
                 self._answers = {
-                    to_abs(line.strip()) for line in fi.readlines() if line.strip()
+                    paths.intern(to_abs(line.strip()))
+                    for line in fi.readlines()
+                    if line.strip()
                 }
             logger.debug(f"loaded {len(self._answers)} answers")
 
-    def already_selected(self, files: List[str]):
-        normalized = {to_abs(f): f for f in files}
+    def already_selected(self, files: List[FileId]):
+        # one id per normalized path, keeps the first of aliases
+        normalized = {paths.intern(paths.absolute(f)): f for f in files}
         selected = [normalized[k] for k in normalized if k in self._answers]
         leftovers = [normalized[k] for k in normalized if k not in self._answers]
         return selected, leftovers
 
-    def save_answer(self, files: List[str]):
-        with ctx.answers_filename.open(encoding="utf-8", mode="a") as fo:
-            for file in files:
-                normalized = to_abs(file)
-                if normalized not in self._answers:
-                    self._answers.add(normalized)
-                    fo.write(normalized + "\n")
+    def save_answer(self, files: List[FileId]):
+        for file_id in files:
+            normalized = paths.absolute(file_id)
+            answer = paths.intern(normalized)
+            if answer not in self._answers:
+                self._answers.add(answer)
+                journal.append(ctx.answers_filename, normalized)
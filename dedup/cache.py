@@ -1,23 +1,81 @@
 import os
 import pickle
+import time
+from typing import Dict, List, Optional
 
+from . import index
 from . import logger
 from .context import ctx
 from .misc import del_file
+from .reader import File, Record
 
 
 def cache_file(directory):
     return os.path.join(directory, ctx.cache_filename)
 
 
+def _restore(cls, state, records, others):
+    dir_cache = cls.__new__(cls)
+    dir_cache.__dict__.update(state)
+    for record in records:
+        dir_cache[record.filename] = record
+    dir_cache.update(others)
+    return dir_cache
+
+
 class DirCache(dict):
     def __init__(self, directory: str):
         self.cache_path = cache_file(directory)
+        # directory listing, lets an unchanged directory skip scandir
+        self.dir_mtime_ns: Optional[int] = None
+        self.entry_count = 0
+        self.subdirs: List[str] = []
+
+    def __reduce__(self):
+        # file records know their path, no need to pickle it as the key too
+        records = [v for v in self.values() if isinstance(v, Record)]
+        others = {k: v for k, v in self.items() if not isinstance(v, Record)}
+        return (_restore, (type(self), self.__dict__, records, others))
+
+    def set_listing(self, dir_stat, subdirs: List[str], entry_count: int):
+        self.subdirs = subdirs
+        self.entry_count = entry_count
+        if time.time_ns() - dir_stat.st_mtime_ns > ctx.listing_grace_ns:
+            self.dir_mtime_ns = dir_stat.st_mtime_ns
+        else:
+            # may still change within the same timestamp tick, list it again
+            self.dir_mtime_ns = None
+
+    def copy_listing(self, other: "DirCache"):
+        self.dir_mtime_ns = other.dir_mtime_ns
+        self.entry_count = other.entry_count
+        self.subdirs = other.subdirs
+
+    def listing_valid(self, dir_stat) -> bool:
+        """cached listing still matches the directory"""
+        return (
+            self.dir_mtime_ns is not None
+            and self.dir_mtime_ns == dir_stat.st_mtime_ns
+            and self.entry_count == len(self) + len(self.subdirs)
+        )
 
     def store(self):
         if not ctx.dry_run:
-            with open(self.cache_path, "wb") as fo:
+            directory = os.path.dirname(self.cache_path)
+            if self.dir_mtime_ns is not None:
+                if os.stat(directory).st_mtime_ns != self.dir_mtime_ns:
+                    # changed since it was listed
+                    self.dir_mtime_ns = None
+            # write aside and swap, an interrupted store keeps the old cache
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "wb") as fo:
                 pickle.dump(self, fo)
+            os.replace(tmp_path, self.cache_path)
+            if self.dir_mtime_ns is not None:
+                # writing the cache touched the directory, stamp the cache file
+                # with the new directory mtime, load() compares against it
+                self.dir_mtime_ns = os.stat(directory).st_mtime_ns
+                os.utime(self.cache_path, ns=(time.time_ns(), self.dir_mtime_ns))
 
     def load(self):
         if os.path.exists(self.cache_path):
@@ -26,6 +84,9 @@ class DirCache(dict):
                     fixed_cache = pickle.load(fi)
                     # fixed_cache = {to_abs(k): v for (k,v) in pickle.load(fi).items()}
                     self.update(fixed_cache)
+                    if getattr(fixed_cache, "dir_mtime_ns", None) is not None:
+                        self.copy_listing(fixed_cache)
+                        self.dir_mtime_ns = os.fstat(fi.fileno()).st_mtime_ns
                 except Exception as e:
                     logger.info(f"unable to load {self.cache_path}. {e}")
             # self.store()
@@ -37,21 +98,102 @@ class DirCache(dict):
         del_file(self.cache_path)
 
 
+class IndexCache(DirCache):
+    """DirCache kept in the central index instead of a cache file."""
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.directory = str(directory)
+
+    def store(self):
+        if not ctx.dry_run:
+            index.get().replace_directory(
+                self.directory,
+                [
+                    f.to_row()
+                    for f in self.values()
+                    if isinstance(f, File) and f.size is not None
+                ],
+                (self.dir_mtime_ns, self.entry_count, self.subdirs),
+            )
+
+    def load(self):
+        for row in index.get().directory(self.directory):
+            self[row[0]] = File.from_row(row, self.directory)
+        listing = index.get().listing(self.directory)
+        if listing:
+            self.dir_mtime_ns, self.entry_count, self.subdirs = listing
+
+    def wipe(self):
+        if not ctx.dry_run:
+            index.get().wipe_directory(self.directory)
+
+
+def _cache_class():
+    return IndexCache if ctx.index_path else DirCache
+
+
+class WriteBack:
+    """Store directory caches whose files got new digests.
+
+    Flushes at most every ctx.cache_flush_interval seconds while hashing,
+    call flush() once more when done or interrupted. Without directories
+    the owning caches are loaded when flushed and the touched files
+    replace their records.
+    """
+
+    def __init__(self, directories: Optional[Dict[str, DirCache]] = None):
+        self.directories = directories
+        self._dirty: Dict[str, Dict[str, File]] = {}
+        self._flushed = time.monotonic()
+
+    def touch(self, directory: str, file_obj: Optional[File] = None):
+        files = self._dirty.setdefault(directory, {})
+        if file_obj is not None:
+            files[file_obj.filename] = file_obj
+        if time.monotonic() - self._flushed >= ctx.cache_flush_interval:
+            self.flush()
+
+    def flush(self):
+        for directory, files in self._dirty.items():
+            if self.directories is not None:
+                dir_cache = self.directories.get(directory)
+            else:
+                dir_cache = load(directory)
+                dir_cache.update((k, v) for k, v in files.items() if k in dir_cache)
+            if dir_cache is not None:
+                dir_cache.store()
+        commit()
+        if self._dirty:
+            logger.debug(f"stored {len(self._dirty)} directory caches")
+        self._dirty.clear()
+        self._flushed = time.monotonic()
+
+
+def commit():
+    """Write out batched index updates, nothing to do for cache files."""
+    if ctx.index_path and not ctx.dry_run:
+        index.get().commit()
+
+
 def load(directory: str):
-    cache = DirCache(directory)
+    cache = _cache_class()(directory)
     cache.load()
     return cache
 
 
 def new(directory: str):
-    cache = DirCache(directory)
+    cache = _cache_class()(directory)
     return cache
 
 
 def clear(directory: str):
-    cache = DirCache(directory)
+    cache = _cache_class()(directory)
     cache.wipe()
 
 
 def exists(directory: str):
+    central = index.get()
+    if central:
+        return central.has_directory(directory)
     return os.path.exists(cache_file(directory))
@@ -1,15 +1,80 @@
 import os
+import pickle
 import time
-from typing import Dict, List, Optional, Tuple
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 
 from . import appraiser
 from .misc import ReloadRuleException
 
 from . import logger
 from .context import ctx
+from .journal import journal
+from .paths import files as paths
+from .trees import Unit
 
 FileHash = str
 FilePath = str
+FileId = int
+Signature = Tuple[str, ...]
+
+# context fields a spawned worker needs to decide like the parent
+DECIDER_SETTINGS = (
+    "rerun",
+    "appraiser_rules_filename",
+    "rules_journal_filename",
+    "appraiser_ignore_filename",
+    "appraiser_remove_filename",
+    "answers_filename",
+)
+DECIDE_CHUNK = 1000  # groups per worker job
+
+_decider: Optional[appraiser.Appraiser] = None
+
+
+def signature(files: List[FileId]) -> Signature:
+    """sorted parent directories of a group, shared by copies of folders"""
+    return tuple(sorted({paths.directory(f) for f in files}))
+
+
+def _ask(prompt: str) -> str:
+    # answers so far survive the process being killed at the prompt
+    journal.sync()
+    return input(prompt)
+
+
+def _init_decider(settings: dict):
+    # spawned workers start with a default context, rules are read again
+    global _decider
+    for k, v in settings.items():
+        setattr(ctx, k, v)
+    _decider = appraiser.Appraiser()
+
+
+def _decide(decider, chunk: List[List[FilePath]]):
+    """(kept, redundant) path lists of every group in chunk"""
+    decided = []
+    for filenames in chunk:
+        good, redundant = decider.decide([paths.intern(f) for f in filenames])
+        decided.append(
+            ([paths.absolute(f) for f in good], [paths.absolute(f) for f in redundant])
+        )
+    return decided
+
+
+def _decide_job(chunk: List[List[FilePath]]):
+    return _decide(_decider, chunk)
+
+
+def _group_bytes(filenames: List[FilePath]) -> int:
+    """bytes freed by keeping one file of the group"""
+    for filename in filenames:
+        try:
+            return os.path.getsize(filename) * (len(filenames) - 1)
+        except OSError:
+            continue
+    return 0
 
 
 class Press:
@@ -18,6 +83,8 @@ class Press:
         self._newdirs = {}  # source_dir -> set of suggested new_dirs
         self._auto_newdirs = set()  # activated dirs for auto-move
         self._pending_moves = {}  # source_path -> dest_path
+        self._batch: Dict[Signature, str] = {}  # signature -> kept dir, "-" or "+"
+        self._like: Counter = Counter()  # groups per signature
         self._load_newdirs()
 
     def get_pending_moves(self):
@@ -37,29 +104,101 @@ class Press:
             logger.debug(f"loaded {len(self._newdirs)} newdir mappings")
 
     def _save_newdir(self, source_dirs: List[str], new_dir: str):
-        with ctx.newdirs_filename.open(encoding="utf-8", mode="a") as fo:
-            for source_dir in source_dirs:
-                if source_dir not in self._newdirs:
-                    self._newdirs[source_dir] = set()
-                if new_dir not in self._newdirs[source_dir]:
-                    self._newdirs[source_dir].add(new_dir)
-                    fo.write(f"{source_dir}:{new_dir}\n")
+        for source_dir in source_dirs:
+            if source_dir not in self._newdirs:
+                self._newdirs[source_dir] = set()
+            if new_dir not in self._newdirs[source_dir]:
+                self._newdirs[source_dir].add(new_dir)
+                journal.append(ctx.newdirs_filename, f"{source_dir}:{new_dir}")
+
+    def close(self):
+        """compact the rules journal and make session state durable"""
+        try:
+            self.appraiser.compact_rules()
+        finally:
+            journal.close()
 
-    def _get_suggested_newdirs(self, files: List[str]) -> List[str]:
+    def _get_suggested_newdirs(self, files: List[FileId]) -> List[str]:
         """Get all suggested new directories for the given files."""
         suggestions = set()
         for f in files:
-            file_dir = os.path.dirname(os.path.abspath(f))
+            file_dir = paths.directory(f)
             if file_dir in self._newdirs:
                 suggestions.update(self._newdirs[file_dir])
         return sorted(suggestions)
 
-    def squeeze_redundant(self, dups: Dict[FileHash, List[FilePath]]) -> List[FilePath]:
+    def predecide(
+        self, groups: List[List[FilePath]]
+    ) -> Tuple[List[FilePath], List[List[FilePath]]]:
+        """phase one: decide every group rules, answers and the remove list
+        can in ctx.jobs workers, stored in ctx.decisions_filename for a rerun
+        return files to delete and the groups left for the operator
+        """
+        if ctx.rerun and ctx.decisions_filename.exists():
+            with ctx.decisions_filename.open(mode="rb") as fi:
+                redundant_files, undecided = pickle.load(fi)
+            logger.info(f"{len(undecided)} undecided groups from the last run")
+            return redundant_files, undecided
+
+        chunks = [
+            groups[i : i + DECIDE_CHUNK] for i in range(0, len(groups), DECIDE_CHUNK)
+        ]
+        if ctx.jobs <= 1 or len(chunks) <= 1:
+            results = [_decide(self.appraiser, chunk) for chunk in chunks]
+        elif ctx.pool == "process":
+            # workers read the rules files, make the journal visible first
+            journal.sync()
+            with ProcessPoolExecutor(
+                max_workers=ctx.jobs,
+                initializer=_init_decider,
+                initargs=({k: getattr(ctx, k) for k in DECIDER_SETTINGS},),
+            ) as executor:
+                results = list(executor.map(_decide_job, chunks))
+        else:
+            with ThreadPoolExecutor(max_workers=ctx.jobs) as executor:
+                results = list(
+                    executor.map(lambda chunk: _decide(self.appraiser, chunk), chunks)
+                )
+
         redundant_files = []
-        total = len(dups)
+        undecided = []
+        for decided in results:
+            for good, redundant in decided:
+                redundant_files += redundant
+                if len(good) > 1:
+                    undecided.append(good)
+        logger.info(
+            f"{len(groups) - len(undecided)} groups decided by rules, "
+            f"{len(undecided)} left"
+        )
+        with ctx.decisions_filename.open(mode="wb") as fo:
+            pickle.dump((redundant_files, undecided), fo)
+        return redundant_files, undecided
+
+    def squeeze_redundant(
+        self, dups: Dict[FileHash, List[FilePath]], predecided: bool = False
+    ) -> List[FilePath]:
+        """predecided: dups are the groups predecide left, not decided again"""
+        redundant_files: List[FilePath] = []
+        groups = list(dups.values())
+        if ctx.two_phase:
+            if not predecided:
+                redundant_files, groups = self.predecide(groups)
+            # the biggest savings first
+            sized = sorted(
+                ((_group_bytes(filenames), filenames) for filenames in groups),
+                key=lambda item: item[0],
+                reverse=True,
+            )
+            sizes = [size for size, _ in sized]
+            groups = [filenames for _, filenames in sized]
+            undecided_bytes = sum(sizes)
+        total = len(groups)
         start = time.monotonic()
         bulk = 100
-        for index, (_md5, files) in enumerate(dups.items()):
+        group_ids = [[paths.intern(f) for f in filenames] for filenames in groups]
+        self._like = Counter(signature(files) for files in group_ids)
+        for index, files in enumerate(group_ids):
             while True:
                 if index % bulk == 0:
                     now = time.monotonic() + 1
@@ -69,26 +208,132 @@ class Press:
                         f"{total - index} files left, {velocity} files per second"
                     )
                 good_files, redundant_by_rules = self.appraiser.decide(files)
-                redundant_files += redundant_by_rules
+                redundant_files += [paths.absolute(f) for f in redundant_by_rules]
 
                 if len(good_files) <= 1:
                     break
 
-                logger.info(f"file {index} from {total}")
+                if ctx.two_phase:
+                    logger.info(
+                        f"{total - index:,} groups left, "
+                        f"{undecided_bytes:,} bytes undecided"
+                    )
+                else:
+                    logger.info(f"file {index} from {total}")
                 try:
-                    good_files, redundant = self.filter_by_biobot(good_files)
+                    batched = self._apply_batch(signature(files), good_files)
+                    if batched:
+                        good_files, redundant = batched
+                    else:
+                        good_files, redundant = self.filter_by_biobot(
+                            good_files, signature(files)
+                        )
                     for file in good_files:
                         self.appraiser.add_from_file(file)
-                    redundant_files += redundant
+                    redundant_files += [paths.absolute(f) for f in redundant]
                     break
                 except ReloadRuleException:
                     self.appraiser.reload_rules()
                     continue
 
+            if ctx.two_phase:
+                undecided_bytes -= sizes[index]
             # store good_file to file for future rerun
         return redundant_files
 
-    def filter_by_biobot(self, files) -> Tuple[List[FilePath], List[FilePath]]:
+    def _apply_batch(
+        self, sig: Signature, files: List[FileId]
+    ) -> Optional[Tuple[List[FileId], List[FileId]]]:
+        """the answer given for all groups with sig, None when there is none"""
+        decision = self._batch.get(sig)
+        if decision is None:
+            return None
+        if decision == "-":
+            return [], files
+        if decision == "+":
+            self.appraiser.save_answer(files)
+            return files, []
+        kept = [f for f in files if paths.directory(f) == decision]
+        if len(kept) != 1:
+            # rules already removed the copy in the kept directory
+            return None
+        self.appraiser.save_answer(kept)
+        return kept, [f for f in files if f != kept[0]]
+
+    def _remember_batch(self, sig: Signature, decision: str):
+        self._batch[sig] = decision
+        like = self._like[sig]
+        if decision == "-":
+            logger.info(f"remove all for all {like:,} groups like this\n")
+        elif decision == "+":
+            logger.info(f"leave all for all {like:,} groups like this\n")
+        else:
+            dropped = ", ".join(d for d in sig if d != decision)
+            logger.info(
+                f"keep {decision}, drop {dropped} for all {like:,} groups like this\n"
+            )
+
+    def squeeze_trees(
+        self, units: List[Unit], dups: Dict[FileHash, List[FilePath]]
+    ) -> Tuple[List[FilePath], Dict[FileHash, List[FilePath]]]:
+        """decide duplicate directory trees with one answer each
+        return files to delete and the groups left to decide file by file
+        """
+        key = {f: k for k, filenames in dups.items() for f in filenames}
+        removed: Set[FilePath] = set()
+        for kind, dirs, files, size in units:
+            count = len(files[dirs[0]])
+            if any(self.appraiser.is_ignored(f) for d in files for f in files[d]):
+                # ignored files are never removed, decide the rest file by file
+                logger.info(f"{', '.join(dirs)} hold ignored files, skipped\n")
+                continue
+            if kind == "identical":
+                logger.info(
+                    f"identical directories, {count:,} files, {size:,} bytes each\n"
+                )
+                for index, directory in enumerate(dirs):
+                    logger.info(f"{index}. keep {directory}\n")
+                questions = [str(index) for index in range(len(dirs))]
+            else:
+                logger.info(
+                    f"{dirs[0]} is contained in {dirs[1]}, "
+                    f"{count:,} files, {size:,} bytes\n"
+                )
+                logger.info(f"-. remove {dirs[0]}\n")
+                questions = ["-"]
+            logger.info("s. skip, decide file by file\n")
+            questions.append("s")
+
+            answer = ""
+            while answer not in questions:
+                answer = _ask("select>").lower()
+            if answer == "s":
+                continue
+
+            if kind == "identical":
+                drop = [d for index, d in enumerate(dirs) if index != int(answer)]
+            else:
+                drop = [dirs[0]]
+            doomed = {
+                f for d in drop for f in files[d] if not self.appraiser.is_ignored(f)
+            } - removed
+            # an earlier answer may have removed the copies this one relies on
+            if not all(set(dups[key[f]]) - removed - doomed for f in doomed):
+                logger.warning("copies already removed, decide file by file\n")
+                continue
+            removed |= doomed
+            logger.info(f"{len(doomed):,} files of {', '.join(drop)} removed\n")
+
+        left = {}
+        for _hash, filenames in dups.items():
+            kept = [f for f in filenames if f not in removed]
+            if len(kept) > 1:
+                left[_hash] = kept
+        return sorted(removed), left
+
+    def filter_by_biobot(
+        self, files: List[FileId], sig: Optional[Signature] = None
+    ) -> Tuple[List[FileId], List[FileId]]:
         # return rule, selected file and files to remove
 
         # check if any suggested dir is activated for auto-move
@@ -115,15 +360,34 @@ class Press:
             logger.info(f"{key}. move to {sug}\n")
             questions.append(key)
 
-        files = sorted(files)
-        for index, filename in enumerate(files):
-            logger.info(f"{index}. {filename}\n")
+        files = sorted(files, key=paths.absolute)
+        for index, file_id in enumerate(files):
+            logger.info(f"{index}. {paths.absolute(file_id)}\n")
             questions.append(str(index))
         questions += ["-", "+", "r", "n"]
 
+        # one copy per directory: the answer maps onto every group like this
+        batchable = []
+        if sig and self._like[sig] > 1 and len(sig) == len(files):
+            batchable = [q for q in questions if q.isdigit()] + ["-", "+"]
+            logger.info(
+                f"add * to apply the answer to all {self._like[sig]:,} groups "
+                f"in {', '.join(sig)}\n"
+            )
+            questions += [f"{q}*" for q in batchable]
+
         answer = ""
         while answer not in questions:
-            answer = input("select>").lower()
+            answer = _ask("select>").lower()
+
+        if answer.endswith("*"):
+            # starred answers are only offered for a group signature
+            assert sig is not None
+            answer = answer[:-1]
+            if answer in ("-", "+"):
+                self._remember_batch(sig, answer)
+            else:
+                self._remember_batch(sig, paths.directory(files[int(answer)]))
 
         if answer == "-":
             return [], files
@@ -147,22 +411,22 @@ class Press:
         return [files[keep_index]], files_to_delete
 
     def _move_to_new_location(
-        self, files, new_dir: Optional[str] = None
-    ) -> Tuple[List[FilePath], List[FilePath]]:
+        self, files: List[FileId], new_dir: Optional[str] = None
+    ) -> Tuple[List[FileId], List[FileId]]:
         # prompt for new directory if not provided
         if new_dir is None:
-            new_dir = input("new directory>").strip()
+            new_dir = _ask("new directory>").strip()
             new_dir = os.path.expanduser(new_dir)
             new_dir = os.path.abspath(new_dir)
 
         # save mapping: all source directories -> new_dir
-        source_dirs = list({os.path.dirname(os.path.abspath(f)) for f in files})
+        source_dirs = list({paths.directory(f) for f in files})
         self._save_newdir(source_dirs, new_dir)
 
         # find first existing file to move (checkpoint may be stale)
         source_file = None
         for f in files:
-            if os.path.exists(f):
+            if os.path.exists(paths.absolute(f)):
                 source_file = f
                 break
 
@@ -170,17 +434,18 @@ class Press:
             logger.warning("no source files exist, skipping")
             return [], []
 
-        filename = os.path.basename(source_file)
-        new_path = os.path.join(new_dir, filename)
+        source_path = paths.absolute(source_file)
+        new_path = os.path.join(new_dir, paths.name(source_file))
 
         # record pending move (executed later in _purge)
-        self._pending_moves[source_file] = new_path
-        logger.info(f"queued move: {source_file} -> {new_path}")
+        self._pending_moves[source_path] = new_path
+        logger.info(f"queued move: {source_path} -> {new_path}")
 
         # add new location to rules
-        self.appraiser.add_from_file(new_path)
-        self.appraiser.save_answer([new_path])
+        new_file = paths.intern(new_path)
+        self.appraiser.add_from_file(new_file)
+        self.appraiser.save_answer([new_file])
 
         # all other files are redundant
         files_to_delete = [f for f in files if f != source_file]
-        return [new_path], files_to_delete
+        return [new_file], files_to_delete
@@ -0,0 +1,79 @@
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .reader import File
+
+np: Any
+try:
+    import numpy as np
+except ImportError:  # optional, pip install numpy
+    np = None
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _runs(*columns) -> Tuple["np.ndarray", "np.ndarray"]:
+    """start and length of every run of equal rows in sorted columns"""
+    n = len(columns[0])
+    change = np.zeros(n, dtype=bool)
+    change[:1] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    starts = np.flatnonzero(change)
+    return starts, np.diff(np.append(starts, n))
+
+
+class FileTable:
+    """Columnar view of files for vectorized grouping.
+
+    Row number is the path id, paths[row] the filename. Files without stat
+    data get size -1 and are never grouped.
+    """
+
+    def __init__(self, files: Dict[str, File]):
+        self.paths = list(files)
+        count = len(self.paths)
+        records = list(files.values())
+        self.size = np.fromiter(
+            (-1 if f.size is None else f.size for f in records), np.int64, count
+        )
+        self.dev = np.fromiter((f.dev or 0 for f in records), np.uint64, count)
+        self.ino = np.fromiter((f.ino or 0 for f in records), np.uint64, count)
+
+    def size_groups(self) -> Iterator[Tuple[int, List[str]]]:
+        """(size, sorted filenames) of sizes shared by two or more inodes"""
+        rows = np.flatnonzero(self.size >= 0)
+        if not len(rows):
+            return
+        rows = rows[np.lexsort((self.ino[rows], self.dev[rows], self.size[rows]))]
+        size, dev, ino = self.size[rows], self.dev[rows], self.ino[rows]
+
+        # a new inode starts at every change of (dev, ino); inode 0 means the
+        # filesystem has none, such a path stands alone
+        inode_start = np.zeros(len(rows), dtype=bool)
+        inode_start[:1] = True
+        inode_start[1:] = (dev[1:] != dev[:-1]) | (ino[1:] != ino[:-1]) | (ino[1:] == 0)
+        starts, counts = _runs(size)
+        inodes = np.add.reduceat(inode_start.astype(np.int64), starts)
+        for start, count in zip(starts[inodes > 1], counts[inodes > 1]):
+            group = rows[start : start + count]
+            yield int(size[start]), sorted(self.paths[row] for row in group)
+
+
+def digest_groups(
+    numbers: List[int], digests: List[str], positions: List[int]
+) -> Iterator[Tuple[Tuple[int, str], List[int]]]:
+    """((group number, digest), sorted positions) of pairs seen more than once"""
+    if not numbers:
+        return
+    number = np.asarray(numbers, dtype=np.int64)
+    # fixed width bytes, ordered like the digest strings
+    digest = np.asarray([d.encode("ascii") for d in digests])
+    position = np.asarray(positions, dtype=np.int64)
+    order = np.lexsort((position, digest, number))
+    number, digest, position = number[order], digest[order], position[order]
+    starts, counts = _runs(number, digest)
+    for start, count in zip(starts[counts > 1], counts[counts > 1]):
+        key = (int(number[start]), digest[start].decode("ascii"))
+        yield key, position[start : start + count].tolist()
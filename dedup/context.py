@@ -1,4 +1,5 @@
-from typing import List
+import os
+from typing import List, Optional
 from pathlib import Path
 from dataclasses import dataclass, field
 
@@ -11,8 +12,12 @@ class RunContext:
     dirs: List[Path] = field(default_factory=list)
     unlink: bool = False
     cache_filename: str = ".dedup-meta.cpl"
+    cache_flush_interval: float = 30.0  # seconds between hash write-backs
+    index_path: Optional[Path] = None  # central SQLite index instead of cache files
+    index_batch_size: int = 10000  # rows per index transaction
     progress_filename: Path = Path(".dedup.progress")
     appraiser_rules_filename: Path = Path(".dedup.rules.list")
+    rules_journal_filename: Path = Path(".dedup.rules.journal")
     appraiser_ignore_filename: Path = Path(".dedup.ignore.list")
     appraiser_remove_filename: Path = Path(".dedup.remove.list")
     answers_filename: Path = Path(".dedup.answers.list")
@@ -20,10 +25,39 @@ class RunContext:
     checkpoint_filename: Path = Path(".dedup.checkpoint")
     final_redundant: Path = Path(".dedup.final_redundant")
     pending_moves_filename: Path = Path(".dedup.pending_moves")
+    decisions_filename: Path = Path(".dedup.decisions")
+    two_phase: bool = False  # decide by rules first, then prompt the rest
+    journal_sync_interval: float = 1.0  # seconds between fsyncs of session state
+    journal_compact_entries: int = 10000  # rule changes before compaction
 
     # hash optimization thresholds
     large_file_threshold: int = 100 * 1024 * 1024  # 100MB
     partial_hash_size: int = 10 * 1024 * 1024  # 10MB per segment
+    head_hash_size: int = 4 * 1024  # first sieve stage
+    hash_algo: str = "md5"  # full content digest
+    filter_algo: Optional[str] = None  # head/sample digests, default hash_algo
+    use_mmap: bool = False  # hash large files through mmap
+    mmap_threshold: int = 64 * 1024 * 1024  # 64MB, smallest file to mmap
+    gentle_io: bool = False  # O_NOATIME, fadvise readahead, drop pages after
+    prefetch_size: int = 8 * 1024 * 1024  # read ahead of the next queued file
+    verify: str = "compare"  # large files: compare | hash
+    compare_max_open: int = 64  # larger groups of large files are hashed
+
+    # hashing workers
+    jobs: int = os.cpu_count() or 1
+    pool: str = "thread"  # thread | process
+    walk_jobs: int = 1  # directory traversal threads
+    stream: bool = False  # walk into an on-disk size index, hash in batches
+    stream_batch: int = 100_000  # files per hashed batch of size groups
+    group_memory: int = 512 * 1024 * 1024  # grouping spills sorted runs above
+    columnar: bool = False  # group with NumPy arrays instead of dicts
+    rotational_jobs: int = 1  # hashing workers per spinning disk
+    tree_names: bool = False  # names count in directory tree digests
+
+    # rescan of directories whose mtime did not change: trust | sample | stat
+    rescan_policy: str = "stat"
+    rescan_sample: int = 8  # files stat'ed per directory by the sample policy
+    listing_grace_ns: int = 2 * 10**9  # younger directory mtimes are not trusted
 
 
 ctx = RunContext()
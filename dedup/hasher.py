@@ -0,0 +1,214 @@
+import functools
+import os
+from collections import defaultdict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from . import logger
+from . import verifier
+from .context import ctx
+from .reader import File, FileReader
+
+# (files read, job, job arguments)
+Task = Tuple[List[File], Callable, tuple]
+
+# context fields a spawned worker needs to hash like the parent
+WORKER_SETTINGS = (
+    "large_file_threshold",
+    "partial_hash_size",
+    "head_hash_size",
+    "hash_algo",
+    "filter_algo",
+    "use_mmap",
+    "mmap_threshold",
+    "gentle_io",
+    "prefetch_size",
+)
+
+
+def _hash_job(filename: str, stage: str):
+    return FileReader.digest(filename, stage)
+
+
+def _compare_job(files: List[File]) -> List[List[int]]:
+    # positions, a process worker compares copies of the files
+    position = {id(f): i for i, f in enumerate(files)}
+    return [[position[id(f)] for f in same] for same in verifier.identical(files)]
+
+
+def _devices(task: Task) -> Set[int]:
+    return {f.dev or 0 for f in task[0]}
+
+
+@functools.lru_cache(maxsize=None)
+def rotational(dev: int) -> Optional[bool]:
+    """whether the block device holding dev spins, None when unknown"""
+    block = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    try:
+        # a partition has no queue of its own, its parent disk has
+        real = os.path.realpath(block)
+        for path in (real, os.path.dirname(real)):
+            flag = os.path.join(path, "queue", "rotational")
+            if os.path.exists(flag):
+                with open(flag) as fi:
+                    return fi.read().strip() == "1"
+    except OSError as e:
+        logger.debug(f"unable to read {block}: {e}")
+    return None
+
+
+def device_jobs(dev: int, jobs: int) -> int:
+    """concurrent reads for one device: one for a spinning disk"""
+    if rotational(dev):
+        # a device without a slot would never be read
+        return max(1, min(jobs, ctx.rotational_jobs))
+    return jobs
+
+
+def _init_worker(settings: dict):
+    # spawned workers start with a default context
+    for k, v in settings.items():
+        setattr(ctx, k, v)
+
+
+class HashPool:
+    """Hash many files concurrently.
+
+    Threads are the default: hashlib releases the GIL while digesting,
+    so file reads and hashing overlap across workers.
+    """
+
+    def __init__(self, jobs: Optional[int] = None, kind: Optional[str] = None):
+        self.jobs = max(1, jobs or ctx.jobs)
+        self.kind = kind or ctx.pool
+        self._executor: Optional[Executor] = None
+
+    def __enter__(self):
+        if self.jobs > 1:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    initializer=_init_worker,
+                    initargs=({k: getattr(ctx, k) for k in WORKER_SETTINGS},),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        return self
+
+    def __exit__(self, *exc):
+        if self._executor:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def hash_files(
+        self, files: List[File], stage: str = "full"
+    ) -> Iterator[Tuple[File, Optional[Exception]]]:
+        """fill the stage digest of files, yield (file, error) as they finish"""
+        tasks = [([f], _hash_job, (f.filename, stage)) for f in files]
+
+        def prefetch(task: Task):
+            FileReader.prefetch(task[0][0].filename, stage)
+
+        for task, digest, error in self._schedule(tasks, prefetch):
+            yield self._fill(task[0][0], stage, digest, error)
+
+    def compare_groups(self, groups: List[List[File]]) -> Iterator[List[File]]:
+        """split groups of same-size files by comparing their bytes, yield
+        the byte-identical groups as comparisons finish
+        """
+        tasks = [(group, _compare_job, (group,)) for group in groups]
+        for (group, _, _), positions, error in self._schedule(tasks):
+            if error:
+                logger.warning(f"unable to compare {group[0].filename}: {error}")
+                continue
+            for same in positions:
+                yield [group[i] for i in same]
+
+    def _schedule(
+        self, tasks: List[Task], prefetch: Optional[Callable[[Task], None]] = None
+    ) -> Iterator[Tuple[Task, Any, Optional[Exception]]]:
+        """run tasks, yield (task, result, error) as they finish
+
+        Every device gets its own queue ordered by inode, drained with the
+        concurrency the device takes, so a spinning disk is read by one
+        worker at a time while the other devices keep theirs busy. A task
+        reading files of several devices holds a slot on each of them.
+        """
+        queues: Dict[int, deque] = defaultdict(deque)
+        for task in sorted(tasks, key=lambda t: (t[0][0].dev or 0, t[0][0].ino or 0)):
+            queues[task[0][0].dev or 0].append(task)
+
+        if not self._executor:
+            for queue in queues.values():
+                while queue:
+                    task = queue.popleft()
+                    if queue and prefetch:
+                        prefetch(queue[0])
+                    yield (task, *self._run(task))
+            return
+
+        slots = {
+            dev: device_jobs(dev, self.jobs) for task in tasks for dev in _devices(task)
+        }
+        running: Dict[Future, Task] = {}
+
+        def free(task: Task) -> bool:
+            return all(slots[dev] for dev in _devices(task))
+
+        def submit():
+            # one task per device and round, at most self.jobs in flight
+            while len(running) < self.jobs:
+                ready = [
+                    dev for dev, queue in queues.items() if queue and free(queue[0])
+                ]
+                if not ready:
+                    return
+                for dev in ready[: self.jobs - len(running)]:
+                    if not free(queues[dev][0]):
+                        # an earlier task of this round took a shared device
+                        continue
+                    task = queues[dev].popleft()
+                    for device in _devices(task):
+                        slots[device] -= 1
+                    running[self._executor.submit(task[1], *task[2])] = task
+                    if queues[dev] and prefetch:
+                        prefetch(queues[dev][0])
+
+        try:
+            submit()
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    for dev in _devices(task):
+                        slots[dev] += 1
+                    result: Tuple[Any, Optional[Exception]]
+                    try:
+                        result = future.result(), None
+                    except Exception as e:
+                        result = None, e
+                    yield (task, *result)
+                submit()
+        finally:
+            for future in running:
+                future.cancel()
+
+    @staticmethod
+    def _run(task: Task) -> Tuple[Any, Optional[Exception]]:
+        try:
+            return task[1](*task[2]), None
+        except Exception as e:
+            return None, e
+
+    @staticmethod
+    def _fill(file_obj: File, stage: str, digest, error):
+        if error is None:
+            file_obj.set_digest(stage, digest)
+        return file_obj, error
@@ -0,0 +1,216 @@
+import functools
+import itertools
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+from . import logger
+from .context import ctx
+from .reader import STAGES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    nlink INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    blocks INTEGER,
+    head TEXT,
+    sample TEXT,
+    full TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files(directory);
+CREATE INDEX IF NOT EXISTS files_inode ON files(dev, ino);
+CREATE INDEX IF NOT EXISTS files_size ON files(size);
+CREATE INDEX IF NOT EXISTS files_full ON files(full);
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    entry_count INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
+"""
+
+COLUMNS = ("path", "dev", "ino", "nlink", "size", "mtime_ns", "blocks") + STAGES
+
+# (path, dev, ino, nlink, size, mtime_ns, blocks, head, sample, full)
+Row = Tuple
+
+
+def _prefix_clause(roots: Iterable[str]) -> Tuple[str, List[str]]:
+    """WHERE clause selecting every path below one of roots"""
+    clauses = []
+    params: List[str] = []
+    for root in roots:
+        prefix = root.rstrip(os.sep) + os.sep
+        if prefix == os.sep:
+            return "1", []
+        # os.sep + 1 sorts right after every path under prefix
+        clauses.append("(path >= ? AND path < ?)")
+        params += [prefix, prefix[:-1] + chr(ord(os.sep) + 1)]
+    return " OR ".join(clauses) or "0", params
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Index:
+    """Central SQLite store of file stat data and digests."""
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._pending = 0
+        # traversal threads share the connection, one statement at a time
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(files)")}
+        if "blocks" not in columns:
+            # index written before sparse files were tracked
+            self._db.execute("ALTER TABLE files ADD COLUMN blocks INTEGER")
+
+    @_locked
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    @_locked
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    @_locked
+    def directory(self, directory: str) -> List[Row]:
+        return self._db.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM files WHERE directory = ?",
+            (directory,),
+        ).fetchall()
+
+    @_locked
+    def listing(self, directory: str) -> Optional[Tuple[int, int, List[str]]]:
+        """(mtime_ns, entry_count, subdirs) recorded for directory"""
+        row = self._db.execute(
+            "SELECT mtime_ns, entry_count, subdirs FROM directories "
+            "WHERE directory = ?",
+            (directory,),
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0], row[1], row[2].split("\0") if row[2] else []
+
+    @_locked
+    def has_directory(self, directory: str) -> bool:
+        row = self._db.execute(
+            "SELECT 1 FROM files WHERE directory = ? LIMIT 1", (directory,)
+        ).fetchone()
+        return row is not None
+
+    @_locked
+    def replace_directory(
+        self,
+        directory: str,
+        rows: List[Row],
+        listing: Tuple[Optional[int], int, List[str]] = (None, 0, []),
+    ):
+        """Batched upsert of one directory listing, drops vanished files."""
+        mtime_ns, entry_count, subdirs = listing
+        self._db.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+            (directory, mtime_ns, entry_count, "\0".join(subdirs)),
+        )
+        self._db.execute("DELETE FROM files WHERE directory = ?", (directory,))
+        self._db.executemany(
+            f"INSERT OR REPLACE INTO files (directory, {', '.join(COLUMNS)}) "
+            f"VALUES (?, {', '.join('?' * len(COLUMNS))})",
+            [(directory,) + tuple(row) for row in rows],
+        )
+        self._pending += len(rows) + 1
+        if self._pending >= ctx.index_batch_size:
+            self.commit()
+
+    @_locked
+    def wipe_directory(self, directory: str):
+        self._db.execute("DELETE FROM files WHERE directory = ?", (directory,))
+        self._db.execute("DELETE FROM directories WHERE directory = ?", (directory,))
+        self.commit()
+
+    @_locked
+    def size_groups(
+        self, roots: Iterable[str], algorithm: str
+    ) -> List[Tuple[int, List[str]]]:
+        """(size, sorted paths) of sizes shared under roots, except sizes
+        every file of which has an algorithm full digest: digest_groups
+        """
+        where, params = _prefix_clause(list(roots))
+        cursor = self._db.execute(
+            f"SELECT size, path FROM files WHERE ({where}) AND size IN ("
+            f"SELECT size FROM files WHERE {where} GROUP BY size "
+            "HAVING COUNT(*) > 1 AND COUNT(*) > TOTAL(full LIKE ?)) "
+            "ORDER BY size, path",
+            params + params + [f"{algorithm}:%"],
+        )
+        return [
+            (size, [path for _, path in rows])
+            for size, rows in itertools.groupby(cursor, key=lambda row: row[0])
+        ]
+
+    @_locked
+    def digest_groups(
+        self, roots: Iterable[str], algorithm: str
+    ) -> List[Tuple[str, List[str]]]:
+        """(full digest, sorted paths) of digests shared under roots, of the
+        sizes every file of which has an algorithm full digest, so no file
+        outside the group can have the same content
+        """
+        where, params = _prefix_clause(list(roots))
+        tag = f"{algorithm}:%"
+        cursor = self._db.execute(
+            f"SELECT full, path FROM files WHERE ({where}) AND full IN ("
+            f"SELECT full FROM files WHERE ({where}) AND size IN ("
+            f"SELECT size FROM files WHERE {where} GROUP BY size "
+            "HAVING COUNT(*) > 1 AND COUNT(*) = TOTAL(full LIKE ?)) "
+            "GROUP BY full HAVING COUNT(*) > 1) ORDER BY full, path",
+            params + params + params + [tag],
+        )
+        return [
+            (digest, [path for _, path in rows])
+            for digest, rows in itertools.groupby(cursor, key=lambda row: row[0])
+        ]
+
+
+_index: Optional[Index] = None
+# traversal threads may open the index first
+_index_lock = threading.RLock()
+
+
+def get() -> Optional[Index]:
+    """Index configured by ctx.index_path, None for per-directory caches."""
+    global _index
+    if not ctx.index_path:
+        return None
+    with _index_lock:
+        if _index is None or _index.path != str(ctx.index_path):
+            close()
+            logger.debug(f"opening index {ctx.index_path}")
+            _index = Index(str(ctx.index_path))
+        return _index
+
+
+def close():
+    global _index
+    with _index_lock:
+        if _index is not None:
+            _index.close()
+            _index = None
@@ -0,0 +1,72 @@
+import os
+import time
+from pathlib import Path
+from typing import Dict, IO, Iterator, Set
+
+from .context import ctx
+
+
+class Journal:
+    """One buffered append-only writer for all session state files.
+
+    Lines are written through open handles kept per file and made durable
+    with fsync at most every ctx.journal_sync_interval seconds, on sync()
+    and on close(), instead of a reopen and flush per decision.
+    """
+
+    def __init__(self):
+        self._files: Dict[Path, IO[str]] = {}
+        self._dirty: Set[Path] = set()
+        self._synced = time.monotonic()
+
+    def append(self, path: Path, line: str):
+        # absolute: a relative name must not follow a later chdir
+        path = Path(path).absolute()
+        fo = self._files.get(path)
+        if fo is None:
+            fo = self._files[path] = path.open(encoding="utf-8", mode="a")
+        fo.write(line + "\n")
+        self._dirty.add(path)
+        if time.monotonic() - self._synced >= ctx.journal_sync_interval:
+            self.sync()
+
+    def sync(self):
+        for path in self._dirty:
+            fo = self._files[path]
+            fo.flush()
+            os.fsync(fo.fileno())
+        self._dirty.clear()
+        self._synced = time.monotonic()
+
+    def discard(self, path: Path):
+        """close path and remove it, after its content was compacted"""
+        path = Path(path).absolute()
+        fo = self._files.pop(path, None)
+        self._dirty.discard(path)
+        if fo is not None:
+            fo.close()
+        if path.exists():
+            path.unlink()
+
+    def close(self):
+        self.sync()
+        for fo in self._files.values():
+            fo.close()
+        self._files.clear()
+
+
+def replay(path: Path) -> Iterator[str]:
+    """complete lines of a journal, a line torn by a crash is skipped"""
+    path = Path(path)
+    if not path.exists():
+        return
+    with path.open(encoding="utf-8", mode="rt") as fi:
+        for line in fi:
+            if not line.endswith("\n"):
+                break
+            line = line.strip()
+            if line:
+                yield line
+
+
+journal = Journal()
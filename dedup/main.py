@@ -11,8 +11,11 @@ from pathlib import Path
 
 import click
 
+from dedup import columns
+from dedup import index
 from dedup import processor
 from dedup.context import ctx
+from dedup.reader import ALGORITHMS, IDENTITY_ALGORITHMS
 
 
 @click.group()
@@ -20,12 +23,144 @@ from dedup.context import ctx
 @click.option("--dry-run", is_flag=True, default=False, help="dry run")
 @click.option("--dirs", "-d", multiple=True, help="directories")
 @click.option("-c", is_flag=True, default=False, help="continue previous run")
-def cli(verbose, dry_run, dirs, c):
+@click.option("--jobs", "-j", type=int, default=None, help="hashing workers")
+@click.option(
+    "--pool",
+    type=click.Choice(["thread", "process"]),
+    default="thread",
+    help="hashing worker type",
+)
+@click.option(
+    "--mmap",
+    "use_mmap",
+    is_flag=True,
+    default=False,
+    help="hash large files through mmap",
+)
+@click.option(
+    "--gentle-io",
+    is_flag=True,
+    default=False,
+    help="no atime updates, read ahead, drop hashed files from the page cache",
+)
+@click.option(
+    "--verify",
+    type=click.Choice(["compare", "hash"]),
+    default="compare",
+    help="confirm large duplicates by comparing bytes or by a full hash",
+)
+@click.option(
+    "--rotational-jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="hashing workers per spinning disk",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="bounded memory: index sizes on disk, load only colliding files",
+)
+@click.option(
+    "--group-memory",
+    type=click.IntRange(min=1),
+    default=512,
+    help="MB of grouping records kept in memory before sorted runs spill to disk",
+)
+@click.option(
+    "--columnar",
+    is_flag=True,
+    default=False,
+    help="group sizes and digests with NumPy arrays",
+)
+@click.option(
+    "--tree-names",
+    is_flag=True,
+    default=False,
+    help="names count when comparing directory trees",
+)
+@click.option(
+    "--two-phase",
+    is_flag=True,
+    default=False,
+    help="decide all groups rules can first, then prompt biggest savings first",
+)
+@click.option("--walk-jobs", type=int, default=1, help="directory traversal threads")
+@click.option(
+    "--rescan",
+    type=click.Choice(["trust", "sample", "stat"]),
+    default="stat",
+    help="how files of directories with unchanged mtime are checked",
+)
+@click.option(
+    "--index",
+    "index_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="central SQLite index instead of per-directory cache files",
+)
+@click.option(
+    "--hash",
+    "hash_algo",
+    type=click.Choice(IDENTITY_ALGORITHMS),
+    default="md5",
+    help="digest proving two files are identical",
+)
+@click.option(
+    "--filter-hash",
+    "filter_algo",
+    type=click.Choice(sorted(ALGORITHMS)),
+    default=None,
+    help="digest of the head/sample stages, defaults to --hash",
+)
+def cli(
+    verbose,
+    dry_run,
+    dirs,
+    c,
+    jobs,
+    pool,
+    use_mmap,
+    gentle_io,
+    verify,
+    rotational_jobs,
+    stream,
+    group_memory,
+    columnar,
+    tree_names,
+    two_phase,
+    walk_jobs,
+    rescan,
+    index_path,
+    hash_algo,
+    filter_algo,
+):
     click.echo("Verbose mode is %s" % ("on" if verbose else "off"))
     ctx.verbose = verbose
     ctx.dry_run = dry_run
     ctx.rerun = c
     ctx.dirs = dirs
+    if jobs:
+        ctx.jobs = jobs
+    ctx.pool = pool
+    ctx.use_mmap = use_mmap
+    ctx.gentle_io = gentle_io
+    ctx.verify = verify
+    ctx.rotational_jobs = rotational_jobs
+    ctx.walk_jobs = walk_jobs
+    ctx.stream = stream
+    ctx.group_memory = group_memory * 1024 * 1024
+    if columnar and not columns.available():
+        raise click.UsageError("--columnar needs numpy: pip install 'dedup[columnar]'")
+    ctx.columnar = columnar
+    ctx.tree_names = tree_names
+    ctx.two_phase = two_phase
+    ctx.rescan_policy = rescan
+    ctx.hash_algo = hash_algo
+    ctx.filter_algo = filter_algo
+    if index_path:
+        ctx.index_path = Path(index_path).resolve()
+        click.get_current_context().call_on_close(index.close)
 
     if verbose:
         loglevel = logging.DEBUG
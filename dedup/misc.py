@@ -1,9 +1,9 @@
 import os
-from pathlib import Path
 
 import send2trash
 from . import logger
 from .context import ctx
+from .paths import normalize
 
 
 class ReloadRuleException(BaseException): ...
@@ -23,4 +23,4 @@ def del_file(file_path: str):
 
 
 def to_abs(path: str):
-    return str(Path(path).resolve())
+    return normalize(path)
@@ -0,0 +1,93 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+class DirectoryTable:
+    """Intern directory paths, file records refer to their parent by id."""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._paths: List[str] = []
+        self._resolved: List[Optional[str]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def intern(self, directory: str) -> int:
+        dir_id = self._ids.get(directory)
+        if dir_id is None:
+            with self._lock:
+                dir_id = self._ids.get(directory)
+                if dir_id is None:
+                    dir_id = len(self._paths)
+                    # one shared string per directory, pickle memoizes it too
+                    self._paths.append(directory)
+                    self._resolved.append(None)
+                    self._ids[directory] = dir_id
+        return dir_id
+
+    def path(self, dir_id: int) -> str:
+        return self._paths[dir_id]
+
+    def resolved(self, dir_id: int) -> str:
+        """the directory with symlinks resolved, resolved once per directory"""
+        resolved = self._resolved[dir_id]
+        if resolved is None:
+            resolved = self._resolved[dir_id] = str(Path(self._paths[dir_id]).resolve())
+        return resolved
+
+
+class PathTable:
+    """Intern file paths as compact ids with a normalized absolute path.
+
+    A path is keyed by its absolute form, its directory is interned in a
+    DirectoryTable and resolved once for all files in it.
+    """
+
+    def __init__(self, dirs: DirectoryTable):
+        self.dirs = dirs
+        self._ids: Dict[str, int] = {}
+        self._entries: List[Tuple[int, str]] = []  # (directory id, name)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def intern(self, path: str) -> int:
+        path = os.path.abspath(path)
+        file_id = self._ids.get(path)
+        if file_id is None:
+            with self._lock:
+                file_id = self._ids.get(path)
+                if file_id is None:
+                    directory, name = os.path.split(path)
+                    file_id = len(self._entries)
+                    self._entries.append((self.dirs.intern(directory), name))
+                    self._ids[path] = file_id
+        return file_id
+
+    def name(self, file_id: int) -> str:
+        return self._entries[file_id][1]
+
+    def directory(self, file_id: int) -> str:
+        """normalized absolute directory of the file"""
+        return self.dirs.resolved(self._entries[file_id][0])
+
+    def absolute(self, file_id: int) -> str:
+        """normalized absolute path, the directory part resolved"""
+        dir_id, name = self._entries[file_id]
+        if not name:
+            return self.dirs.resolved(dir_id)
+        return os.path.join(self.dirs.resolved(dir_id), name)
+
+
+directories = DirectoryTable()
+files = PathTable(directories)
+
+
+def normalize(path: str) -> str:
+    """absolute path with symlinked directories resolved, cached"""
+    return files.absolute(files.intern(path))
@@ -8,10 +8,18 @@ from typing import Any, Dict, List, Tuple
 from pathlib import Path
 
 from .walker import Walker
+from .reader import STAGES, File
 from .misc import del_file
 from . import cache
 from . import colander
+from . import columns
+from . import hasher
+from . import index
+from . import sizes
+from . import spill
+from . import trees
 from .context import ctx
+from .journal import journal
 from . import logger
 
 
@@ -19,6 +27,7 @@ class Processor:
     def __init__(self, dirs):
         super().__init__()
         self.dirs = dirs
+        self.directories = {}  # directory caches of the last walk
 
         self.press = colander.Press()
 
@@ -26,7 +35,7 @@ class Processor:
         menu = """
 What do you want to clear?
   1. Hash cache      - .dedup-meta.cpl files in scanned directories (speeds up re-scans)
-  2. Session files   - checkpoint, final_redundant, pending_moves (current dedup session)
+  2. Session files   - checkpoint, final_redundant, pending_moves, decisions (current dedup session)
   3. Saved answers   - answers, newdirs (user decisions from previous runs)
   4. Rules           - rules, ignore, remove lists (appraiser patterns)
   5. All of the above
@@ -67,6 +76,7 @@ What do you want to clear?
             ctx.final_redundant,
             ctx.pending_moves_filename,
             ctx.progress_filename,
+            ctx.decisions_filename,
         ]:
             if f.exists():
                 f.unlink()
@@ -83,6 +93,7 @@ What do you want to clear?
         logger.info("clearing rules...")
         for f in [
             ctx.appraiser_rules_filename,
+            ctx.rules_journal_filename,
             ctx.appraiser_ignore_filename,
             ctx.appraiser_remove_filename,
         ]:
@@ -92,30 +103,98 @@ What do you want to clear?
 
     def calculus(self) -> Tuple[Dict[str, Any], Dict[str, List[str]]]:
         # calculates a full tree and duplicates
-        accoumulation = {}
-        all_directories = {}
+        if ctx.stream:
+            return self._stream()
         w = Walker()
-
-        for d in self.dirs:
-            files, directories = w.build(d)
-            accoumulation.update(files)
-            all_directories.update(directories)
+        accoumulation, all_directories = w.build_all(self.dirs)
+        self.directories = all_directories
 
         for dir_cache in all_directories.values():
             if dir_cache:
                 dir_cache.store()
-
-        duplicates = self._duplicates(accoumulation)
+        cache.commit()
+
+        size_groups = None
+        hashed = []
+        central = index.get()
+        if central and not ctx.dry_run:
+            # the index holds the tree: collisions are queried, not grouped
+            roots = [str(Path(d).resolve()) for d in self.dirs]
+            size_groups = central.size_groups(roots, ctx.hash_algo)
+            hashed = central.digest_groups(roots, ctx.hash_algo)
+
+        write_back = cache.WriteBack(all_directories)
+        try:
+            duplicates = self._duplicates(
+                accoumulation, write_back, size_groups, hashed
+            )
+        finally:
+            # keep completed hashing work, also on Ctrl-C
+            write_back.flush()
 
         return accoumulation, duplicates
 
+    def _stream(self) -> Tuple[Dict[str, Any], Dict[str, List[str]]]:
+        """calculus without holding the tree: the walk feeds an on-disk size
+        index, size groups are hashed in batches of ctx.stream_batch files
+        return files of duplicate groups only and duplicates
+        """
+        files: Dict[str, File] = {}
+        duplicates: Dict[str, List[str]] = {}
+        with sizes.SizeIndex() as size_index:
+            Walker().build_all(self.dirs, sink=size_index.add)
+            logger.info(f"{size_index.count} files indexed by size")
+
+            write_back = cache.WriteBack()
+            try:
+                # batches only hold colliding sizes, the index is not queried
+                for batch in size_index.batches(ctx.stream_batch):
+                    batch_files = {f.filename: f for f in batch}
+                    dups = self._duplicates(batch_files, write_back)
+                    duplicates.update(dups)
+                    for filenames in dups.values():
+                        files.update((f, batch_files[f]) for f in filenames)
+            finally:
+                # keep completed hashing work, also on Ctrl-C
+                write_back.flush()
+        return files, duplicates
+
+    def trees(self, dups) -> List[trees.Unit]:
+        """identical and contained directory trees of the duplicates"""
+        roots = [str(Path(d).resolve()) for d in self.dirs]
+        return trees.Trees(dups, roots, self.directories).find()
+
     def stats(self):
         # display all
         files, dups = self.calculus()
-        for md5, files in dups.items():
+        for md5, filenames in dups.items():
             logger.info(f"{md5}")
-            for filename in files:
-                logger.info(f"\t{filename}")
+            for filename in filenames:
+                file_obj = files.get(filename)
+                if file_obj is not None and file_obj.sparse:
+                    logger.info(
+                        f"\t{filename} (sparse, {file_obj.allocated:,} of "
+                        f"{file_obj.size:,} bytes allocated)"
+                    )
+                else:
+                    logger.info(f"\t{filename}")
+        units = self.trees(dups)
+        for kind, dirs, tree_files, size in units:
+            count = len(tree_files[dirs[0]])
+            if kind == "identical":
+                logger.info(f"identical trees, {count} files, {size:,} bytes each")
+                for directory in dirs:
+                    logger.info(f"\t{directory}")
+            else:
+                logger.info(
+                    f"{dirs[0]} is contained in {dirs[1]}, "
+                    f"{count} files, {size:,} bytes"
+                )
+        logger.info(
+            f"{len(dups)} duplicate groups, {len(units)} duplicate trees, "
+            f"{self.reclaimable(files, dups):,} bytes reclaimable, "
+            f"{self.reclaimable(files, dups, allocated=True):,} bytes allocated"
+        )
 
     def dedup(self):
         if ctx.checkpoint_filename.exists() and ctx.rerun:
@@ -138,7 +217,24 @@ What do you want to clear?
             else:
                 pending_moves = {}
         else:
-            files_to_delete = self.press.squeeze_redundant(dups)
+            if not ctx.rerun:
+                # left by a crashed session, only -c continues it
+                journal.discard(ctx.rules_journal_filename)
+            try:
+                decided = []
+                if ctx.two_phase:
+                    # rules first, the operator only sees what they leave
+                    decided, groups = self.press.predecide(list(dups.values()))
+                    key = {f: k for k, filenames in dups.items() for f in filenames}
+                    dups = {key[filenames[0]]: filenames for filenames in groups}
+                # whole directories first, one answer each
+                files_to_delete, left = self.press.squeeze_trees(self.trees(dups), dups)
+                files_to_delete += decided
+                files_to_delete += self.press.squeeze_redundant(
+                    left, predecided=ctx.two_phase
+                )
+            finally:
+                self.press.close()
             pending_moves = self.press.get_pending_moves()
             with ctx.final_redundant.open(mode="wb") as fo:
                 pickle.dump(files_to_delete, fo)
@@ -233,60 +329,165 @@ What do you want to clear?
             else:
                 logger.info("unknown input\n")
 
-    def _duplicates(self, files):
-        from .reader import FileReader
-
+    def _duplicates(self, files, write_back=None, size_groups=None, hashed=()):
+        """size_groups: (size, filenames) queried from the index, hashed:
+        (digest, filenames) the index already found identical
+        """
         # pass 1: group by size
-        by_size = defaultdict(list)
+        if size_groups is None:
+            size_groups = self._size_groups(files)
+        groups = []
+        links = []  # (representative, other links of its inode)
+        for _, filenames in size_groups:
+            group = self._representatives(files, filenames, links)
+            if group:
+                groups.append(group)
+
+        total_collisions = sum(len(group) for group in groups)
+        logger.info(
+            f"size collisions: {total_collisions} files in {len(groups)} groups"
+        )
+
+        # pass 2: sieve size groups through the hashing stages
+        with hasher.HashPool() as pool:
+            for stage in STAGES:
+                groups = self._sieve(pool, groups, stage, write_back)
+
+        confirmed = [self._representatives(files, f, links) for _, f in hashed]
+        groups += [group for group in confirmed if group]
+
+        for representative, others in links:
+            for file_obj in others:
+                if file_obj.digests != representative.digests:
+                    file_obj.digests = representative.digests
+                    if write_back:
+                        write_back.touch(file_obj.directory, file_obj)
+
+        return {self._group_key(group): [f.filename for f in group] for group in groups}
+
+    @staticmethod
+    def _representatives(files, filenames, links):
+        """one file per inode, None unless two inodes are left
+        the other links of an inode are added to links
+        """
+        # hardlinks share content: one representative per inode
+        by_inode = defaultdict(list)
+        for filename in filenames:
+            file_obj = files.get(filename)
+            if file_obj is not None:
+                by_inode[file_obj.inode].append(file_obj)
+        if len(by_inode) < 2:
+            return None
+        group = []
+        for same in by_inode.values():
+            # the link with the deepest cached stage saves the most work
+            representative = max(same, key=lambda f: f.depth)
+            group.append(representative)
+            if len(same) > 1:
+                links.append(
+                    (representative, [f for f in same if f is not representative])
+                )
+        return group
+
+    @staticmethod
+    def _group_key(group):
+        # groups confirmed by comparing bytes have no full digest
+        return group[0].digest("full") or f"bytes:{group[0].size}:{group[0].filename}"
+
+    def _size_groups(self, files):
+        """(size, sorted filenames) of sizes shared by several files"""
+        if ctx.columnar:
+            yield from columns.FileTable(files).size_groups()
+            return
+        by_size = spill.Grouper()
         for filename, file_obj in files.items():
             try:
-                by_size[file_obj.size].append((filename, file_obj))
+                by_size.add(file_obj.size, filename)
             except Exception as e:
                 logger.warning(f"unable to get size for {filename}: {e}")
-
-        # filter to size collisions only
-        size_collisions = {sz: items for sz, items in by_size.items() if len(items) > 1}
-        total_collisions = sum(len(items) for items in size_collisions.values())
-        logger.info(
-            f"size collisions: {total_collisions} files in {len(size_collisions)} groups"
+        yield from by_size.groups()
+
+    def reclaimable(self, files, dups, allocated=False) -> int:
+        """bytes freed by keeping one file per group, logical sizes or with
+        allocated=True the disk space, which is less for sparse files
+
+        paths are one per inode, an inode with links outside the group is
+        not freed by deleting the listed path, so at best one of them is kept.
+        """
+        total = 0
+        for filenames in dups.values():
+            group = [files[f] for f in filenames if f in files]
+            if not group:
+                continue
+            singles = sorted(
+                (f.allocated if allocated else f.size) for f in group if f.nlink <= 1
+            )
+            if len(singles) == len(group):
+                # the kept copy: the smallest, others may be denser copies
+                singles = singles[1:]
+            total += sum(singles)
+        return total
+
+    def _compared(self, group):
+        """large files are confirmed by comparing bytes rather than hashing"""
+        return (
+            ctx.verify == "compare"
+            and group[0].size > ctx.large_file_threshold
+            and len(group) <= ctx.compare_max_open
+            and any(f.digest("full") is None for f in group)
         )
 
-        # pass 2: hash only files with size collisions
-        by_hash = defaultdict(list)
-        for size, items in size_collisions.items():
-            for filename, file_obj in items:
-                try:
-                    if not file_obj.hashed:
-                        file_obj.ensure_hash()
-                    by_hash[file_obj.hash].append(filename)
-                except Exception as e:
-                    logger.warning(f"unable to hash {filename}: {e}")
-
-        # filter to hash collisions
-        candidates = {h: fnames for h, fnames in by_hash.items() if len(fnames) > 1}
-
-        # pass 3: verify large files with full hash
-        verified = {}
-        for quick_hash, filenames in candidates.items():
-            has_large = any(
-                os.path.getsize(f) > ctx.large_file_threshold
-                for f in filenames
-                if os.path.exists(f)
-            )
-            if not has_large:
-                verified[quick_hash] = filenames
+    def _sieve(self, pool, groups, stage, write_back=None):
+        """split groups by the stage digest, drop files left without a peer"""
+        deeper = STAGES[STAGES.index(stage) + 1 :]
+        refined = []
+        if stage == "full":
+            compared = [group for group in groups if self._compared(group)]
+            if compared:
+                logger.info(f"comparing {len(compared)} groups of large files")
+                groups = [group for group in groups if not self._compared(group)]
+                refined += pool.compare_groups(compared)
+
+        def decided_later(group):
+            # cached digests of a deeper stage will split this group anyway
+            return any(all(f.digest(s) for f in group) for s in deeper)
+
+        pending = [
+            f
+            for group in groups
+            if not decided_later(group)
+            for f in group
+            if f.digest(stage) is None
+        ]
+        if pending:
+            logger.info(f"{stage} hashing {len(pending)} files")
+        for file_obj, error in pool.hash_files(pending, stage):
+            if error:
+                logger.warning(f"unable to hash {file_obj.filename}: {error}")
+            elif write_back:
+                write_back.touch(file_obj.directory, file_obj)
+
+        # (group number, digest) keys, positions in the group as items
+        records = []
+        for number, group in enumerate(groups):
+            if any(f.digest(stage) is None for f in group) and decided_later(group):
+                refined.append(group)
                 continue
-
-            # re-hash large files with full hash
-            logger.info(f"verifying {len(filenames)} large files...")
-            full_hashes = defaultdict(list)
-            for f in filenames:
-                if os.path.exists(f):
-                    full_hash = FileReader.hash(f, full=True)
-                    full_hashes[full_hash].append(f)
-
-            for full_hash, verified_files in full_hashes.items():
-                if len(verified_files) > 1:
-                    verified[full_hash] = verified_files
-
-        return verified
+            for position, file_obj in enumerate(group):
+                digest = file_obj.digest(stage)
+                if digest:
+                    records.append((number, digest, position))
+        refined += [
+            [groups[number][position] for position in positions]
+            for (number, _), positions in self._digest_groups(records)
+        ]
+        return refined
+
+    @staticmethod
+    def _digest_groups(records):
+        if ctx.columnar:
+            return columns.digest_groups(*zip(*records)) if records else []
+        by_digest = spill.Grouper()
+        for number, digest, position in records:
+            by_digest.add((number, digest), position)
+        return by_digest.groups()
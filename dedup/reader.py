@@ -1,61 +1,269 @@
+import contextlib
+import errno
+import hashlib
+import mmap
 import os
-
-from hashlib import md5
+import threading
+import zlib
 
 from .context import ctx
+from .paths import directories
+
+
+# progressive hashing stages, cheapest first
+STAGES = ("head", "sample", "full")
+STAGE_INDEX = {stage: i for i, stage in enumerate(STAGES)}
+NO_DIGESTS = (None,) * len(STAGES)
+
+_local = threading.local()
+
+NOATIME = getattr(os, "O_NOATIME", 0)
+SEEK_DATA = getattr(os, "SEEK_DATA", None)
+
+# fed to digests in place of the holes of sparse files
+_ZEROS = bytes(1024 * 1024)
+
+try:
+    import xxhash
+except ImportError:  # optional, pip install xxhash
+    xxhash = None
+
+
+class CRC32:
+    """zlib.crc32 behind the hashlib interface, a fast candidate filter"""
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return f"{self._crc:08x}"
+
+
+# digest constructors by algorithm id, the id is stored with every digest
+ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+    "crc32": CRC32,
+}
+if xxhash:
+    ALGORITHMS["xxh64"] = xxhash.xxh64
+    ALGORITHMS["xxh128"] = xxhash.xxh3_128
+# collisions of the others are easy to make, they only narrow candidates
+IDENTITY_ALGORITHMS = ("blake2b", "md5", "sha1", "sha256")
+
+
+def _restore(
+    cls, directory, name, size, mtime_ns, dev, ino, nlink, digests, blocks=None
+):
+    f = cls.__new__(cls)
+    f.parent = directories.intern(directory)
+    f.name = name
+    f.size = size
+    f.mtime_ns = mtime_ns
+    f.dev = dev
+    f.ino = ino
+    f.nlink = nlink
+    f.digests = digests
+    f.blocks = blocks
+    return f
+
+
+class Record:
+    """Compact file entry: parent directory id, name, the stat fields dedup
+    needs and one digest per stage. Pickles with the directory path instead
+    of the per-process id.
+    """
+
+    __slots__ = (
+        "parent",
+        "name",
+        "size",
+        "mtime_ns",
+        "dev",
+        "ino",
+        "nlink",
+        "digests",
+        "blocks",
+    )
 
+    def __reduce__(self):
+        return (
+            _restore,
+            (
+                type(self),
+                directories.path(self.parent),
+                self.name,
+                self.size,
+                self.mtime_ns,
+                self.dev,
+                self.ino,
+                self.nlink,
+                self.digests,
+                self.blocks,
+            ),
+        )
+
+
+class File(Record):
+    __slots__ = ()
 
-class File:
     def __init__(self, filename, directory):
-        self.filename = filename
-        self._stat = None
-        self._hash = None
-        self.directory = directory
+        self.parent = directories.intern(directory)
+        self.name = os.path.basename(filename)
+        self.size = None
+        self.mtime_ns = None
+        self.dev = None
+        self.ino = None
+        self.nlink = None
+        self.digests = NO_DIGESTS
+        self.blocks = None
+
+    @property
+    def filename(self):
+        return os.path.join(directories.path(self.parent), self.name)
+
+    @property
+    def directory(self):
+        return directories.path(self.parent)
 
     @property
     def hashed(self):
-        return self._hash is not None
+        return self.digest("full") is not None
+
+    @property
+    def depth(self):
+        """number of stages with a known digest"""
+        return sum(1 for stage in STAGES if self.digest(stage))
+
+    @property
+    def allocated(self):
+        """bytes the file occupies on disk, the size where unknown"""
+        self.ensure_stat()
+        if self.blocks is None:
+            return self.size
+        return self.blocks * 512
+
+    @property
+    def sparse(self):
+        return self.allocated < self.size
 
     @property
-    def size(self):
-        return self.stat.st_size
+    def inode(self):
+        """(st_dev, st_ino), shared by hardlinks of the same content"""
+        self.ensure_stat()
+        if not self.ino:
+            # no inode numbers on this filesystem, every path stands alone
+            return (self.dev, self.filename)
+        return (self.dev, self.ino)
+
+    def set_stat(self, st):
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.dev = st.st_dev
+        self.ino = st.st_ino
+        self.nlink = st.st_nlink
+        self.blocks = getattr(st, "st_blocks", None)
 
     def ensure_stat(self):
         """Populate stat for caching (no hashing yet)."""
-        self.stat
+        if self.size is None:
+            self.set_stat(FileReader.stat(self.filename))
 
     def ensure_hash(self):
         """Compute hash (only call for size-collision files)."""
-        self.stat  # populate _stat for cache invalidation
+        self.ensure_stat()  # populate stat for cache invalidation
         self.hash
 
+    def digest(self, stage):
+        """tagged stage digest, None unless made by the stage's algorithm"""
+        digest = self.digests[STAGE_INDEX[stage]]
+        if digest and digest.startswith(FileReader.algorithm(stage) + ":"):
+            return digest
+        return None
+
+    def set_digest(self, stage, digest):
+        self.ensure_stat()
+        digests = list(self.digests)
+        if self.size <= ctx.head_hash_size:
+            # the block covers the whole file, same for every stage
+            # hashed with the same algorithm
+            algorithm = FileReader.algorithm(stage)
+            for s in STAGES:
+                if FileReader.algorithm(s) == algorithm:
+                    digests[STAGE_INDEX[s]] = digest
+        else:
+            digests[STAGE_INDEX[stage]] = digest
+        self.digests = tuple(digests)
+
     @property
     def hash(self):
-        if not self._hash:
-            self._hash = FileReader.hash(self.filename)
-        return self._hash
+        """hex digest of the whole content with ctx.hash_algo"""
+        if not self.hashed:
+            self.set_digest("full", FileReader.digest(self.filename, "full"))
+        return self.digest("full").split(":", 1)[1]
 
     @property
     def stat(self):
-        if not self._stat:
-            self._stat = FileReader.stat(self.filename)
-        return self._stat
+        """os.stat_result view of the fields the record keeps"""
+        self.ensure_stat()
+        mtime = self.mtime_ns / 1e9
+        st = os.stat_result(
+            (0, self.ino, self.dev, self.nlink, 0, 0, self.size, 0, int(mtime), 0)
+            + (0.0, mtime, 0.0, 0, self.mtime_ns, 0)
+        )
+        if self.blocks is not None:
+            st = os.stat_result(st, {"st_blocks": self.blocks})
+        return st
+
+    def to_row(self):
+        """(path, dev, ino, nlink, size, mtime_ns, blocks, *stage digests)
+        for the index
+        """
+        return (
+            self.filename,
+            self.dev,
+            self.ino,
+            self.nlink,
+            self.size,
+            self.mtime_ns,
+            self.blocks,
+        ) + self.digests
 
     @classmethod
-    def from_cache(cls, other: "File"):
-        f = cls(other.filename, other.directory)
-        mst = f.stat
-        ost = other.stat
-        if (mst.st_size, round(mst.st_mtime, 2)) == (
-            ost.st_size,
-            round(ost.st_mtime, 2),
-        ):
-            f._hash = other._hash
+    def from_row(cls, row, directory):
+        f = cls(row[0], directory)
+        f.dev, f.ino, f.nlink, f.size, f.mtime_ns, f.blocks = row[1:7]
+        f.digests = tuple(row[7:])
+        return f
+
+    def same_stat(self, st) -> bool:
+        """st describes the content this file was cached with"""
+        self.ensure_stat()
+        # centiseconds, what filesystems and copies reliably preserve
+        return (st.st_size, st.st_mtime_ns // 10**7) == (
+            self.size,
+            self.mtime_ns // 10**7,
+        )
+
+    @classmethod
+    def from_cache(cls, other: "File", stat=None):
+        f = cls.__new__(cls)
+        f.parent = other.parent
+        f.name = other.name
+        st = stat or FileReader.stat(f.filename)
+        f.set_stat(st)
+        f.digests = other.digests if other.same_stat(st) else NO_DIGESTS
         return f
 
 
 class FileReader:
-    CHUNK_SIZE = 64 * 1024  # 64KB chunks
+    CHUNK_SIZE = 64 * 1024  # 64KB, smallest read
+    MAX_CHUNK_SIZE = 1024 * 1024  # 1MB, largest read
 
     @staticmethod
     def hash(filename, full=False):
@@ -67,43 +275,207 @@ class FileReader:
         return FileReader._hash_partial(filename, file_size)
 
     @staticmethod
-    def _hash_full_file(filename):
-        m = md5()
-        with open(filename, "rb") as fi:
-            while chunk := fi.read(FileReader.CHUNK_SIZE):
-                m.update(chunk)
+    def algorithm(stage):
+        """algorithm id for a sieve stage, filter stages may use a faster one"""
+        if stage == "full":
+            return ctx.hash_algo
+        return ctx.filter_algo or ctx.hash_algo
+
+    @staticmethod
+    def digest(filename, stage):
+        """Hash one stage of the sieve, tagged with the algorithm id.
+
+        head   - first ctx.head_hash_size bytes
+        sample - prefix+middle+suffix for large files, the tail block otherwise
+        full   - whole content
+        """
+        algorithm = FileReader.algorithm(stage)
+        return f"{algorithm}:{FileReader._stage_hex(filename, stage, algorithm)}"
+
+    @staticmethod
+    def _stage_hex(filename, stage, algorithm):
+        if stage == "full":
+            return FileReader._hash_full_file(filename, algorithm)
+
+        file_size = os.path.getsize(filename)
+        if stage == "head" or file_size <= ctx.head_hash_size:
+            m = ALGORITHMS[algorithm]()
+            with FileReader.reading(filename, 0, ctx.head_hash_size) as fi:
+                FileReader._hash_segment(fi, m, ctx.head_hash_size)
+            return m.hexdigest()
+        if file_size > ctx.large_file_threshold:
+            return FileReader._hash_partial(filename, file_size, algorithm)
+
+        m = ALGORITHMS[algorithm]()
+        offset = file_size - ctx.head_hash_size
+        with FileReader.reading(filename, offset, ctx.head_hash_size) as fi:
+            fi.seek(offset)
+            FileReader._hash_segment(fi, m, ctx.head_hash_size)
+        return m.hexdigest()
+
+    @staticmethod
+    def open(filename):
+        """unbuffered binary file, without atime updates when ctx.gentle_io"""
+        if not ctx.gentle_io or not NOATIME:
+            return open(filename, "rb", buffering=0)
+        try:
+            fd = os.open(filename, os.O_RDONLY | NOATIME)
+        except PermissionError as e:
+            # O_NOATIME needs file ownership
+            if e.errno != errno.EPERM:
+                raise
+            fd = os.open(filename, os.O_RDONLY)
+        return open(fd, "rb", buffering=0)
+
+    @staticmethod
+    def advise(fi, offset, length, advice):
+        """posix_fadvise POSIX_FADV_<advice> when ctx.gentle_io and supported"""
+        flag = getattr(os, f"POSIX_FADV_{advice}", None)
+        if ctx.gentle_io and flag is not None:
+            try:
+                os.posix_fadvise(fi.fileno(), offset, length, flag)
+            except OSError:
+                pass  # advice only
+
+    @staticmethod
+    def close(fi):
+        """close fi, dropping its pages from the page cache when ctx.gentle_io"""
+        try:
+            FileReader.advise(fi, 0, 0, "DONTNEED")
+        finally:
+            fi.close()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def reading(filename, offset=0, length=0):
+        """open filename to read length bytes (0: to EOF) from offset"""
+        fi = FileReader.open(filename)
+        try:
+            FileReader.advise(fi, 0, 0, "SEQUENTIAL")
+            FileReader.advise(fi, offset, length, "WILLNEED")
+            yield fi
+        finally:
+            FileReader.close(fi)
+
+    @staticmethod
+    def prefetch(filename, stage):
+        """start reading ahead the part of filename a stage will hash"""
+        if not ctx.gentle_io:
+            return
+        length = ctx.prefetch_size
+        if stage == "head":
+            length = min(length, ctx.head_hash_size)
+        try:
+            with FileReader.open(filename) as fi:
+                FileReader.advise(fi, 0, length, "WILLNEED")
+        except OSError:
+            pass  # the hashing job reports it
+
+    @staticmethod
+    def chunk_size(size, blksize=0):
+        """read size for size bytes: one read for small data, at most
+        MAX_CHUNK_SIZE, rounded up to the filesystem block size
+        """
+        chunk = min(max(size, FileReader.CHUNK_SIZE), FileReader.MAX_CHUNK_SIZE)
+        if blksize:
+            chunk = -(-chunk // blksize) * blksize
+        return chunk
+
+    @staticmethod
+    def _buffer(size):
+        """per-thread read buffer, reused instead of a new bytes per read"""
+        buffer = getattr(_local, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            buffer = _local.buffer = bytearray(size)
+        return memoryview(buffer)[:size]
+
+    @staticmethod
+    def _hash_full_file(filename, algorithm=None):
+        m = ALGORITHMS[algorithm or ctx.hash_algo]()
+        with FileReader.reading(filename) as fi:
+            st = os.fstat(fi.fileno())
+            if SEEK_DATA is not None and getattr(st, "st_blocks", 0) * 512 < st.st_size:
+                FileReader._hash_sparse(fi, m, st)
+            elif ctx.use_mmap and st.st_size >= ctx.mmap_threshold:
+                with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    m.update(mm)
+            else:
+                chunk = FileReader.chunk_size(st.st_size, st.st_blksize)
+                FileReader._hash_segment(fi, m, None, chunk)
         return m.hexdigest()
 
     @staticmethod
-    def _hash_partial(filename, file_size):
+    def _hash_sparse(fi, m, st):
+        """hash the data extents of fi, holes are fed as zeros without reading
+
+        The digest equals the one of the same content written densely.
+        """
+        chunk = FileReader.chunk_size(st.st_size, st.st_blksize)
+        pos = 0
+        while pos < st.st_size:
+            try:
+                data = os.lseek(fi.fileno(), pos, SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                data = st.st_size  # a hole up to the end
+            FileReader._hash_zeros(m, data - pos)
+            if data >= st.st_size:
+                break
+            hole = os.lseek(fi.fileno(), data, os.SEEK_HOLE)
+            fi.seek(data)
+            FileReader._hash_segment(fi, m, hole - data, chunk)
+            pos = hole
+
+    @staticmethod
+    def _hash_zeros(m, size):
+        while size > 0:
+            n = min(size, len(_ZEROS))
+            m.update(_ZEROS[:n] if n < len(_ZEROS) else _ZEROS)
+            size -= n
+
+    @staticmethod
+    def _hash_partial(filename, file_size, algorithm=None):
         """Hash prefix + middle + suffix for large files."""
-        m = md5()
+        m = ALGORITHMS[algorithm or ctx.hash_algo]()
         segment_size = ctx.partial_hash_size
 
-        with open(filename, "rb") as fi:
+        with FileReader.reading(filename, 0, segment_size) as fi:
+            chunk = FileReader.chunk_size(
+                segment_size, os.fstat(fi.fileno()).st_blksize
+            )
+
             # prefix
-            FileReader._hash_segment(fi, m, segment_size)
+            middle_pos = (file_size - segment_size) // 2
+            FileReader.advise(fi, middle_pos, segment_size, "WILLNEED")
+            FileReader._hash_segment(fi, m, segment_size, chunk)
 
             # middle
-            middle_pos = (file_size - segment_size) // 2
             fi.seek(middle_pos)
-            FileReader._hash_segment(fi, m, segment_size)
+            FileReader.advise(fi, file_size - segment_size, segment_size, "WILLNEED")
+            FileReader._hash_segment(fi, m, segment_size, chunk)
 
             # suffix
             fi.seek(file_size - segment_size)
-            FileReader._hash_segment(fi, m, segment_size)
+            FileReader._hash_segment(fi, m, segment_size, chunk)
 
         return m.hexdigest()
 
     @staticmethod
-    def _hash_segment(fi, m, size):
-        bytes_read = 0
-        while bytes_read < size:
-            chunk = fi.read(min(FileReader.CHUNK_SIZE, size - bytes_read))
-            if not chunk:
+    def _hash_segment(fi, m, size, chunk=None):
+        """hash size bytes (None: up to EOF) from fi into m"""
+        if chunk is None:
+            chunk = FileReader.chunk_size(size or 0)
+        view = FileReader._buffer(chunk if size is None else min(chunk, size))
+        remaining = size
+        while remaining is None or remaining > 0:
+            want = view if remaining is None else view[: min(len(view), remaining)]
+            n = fi.readinto(want)
+            if not n:
                 break
-            m.update(chunk)
-            bytes_read += len(chunk)
+            m.update(view[:n])
+            if remaining is not None:
+                remaining -= n
 
     @staticmethod
     def stat(f):
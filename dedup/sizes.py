@@ -0,0 +1,72 @@
+import itertools
+import os
+import sqlite3
+import tempfile
+from typing import Iterator, List
+
+from .index import COLUMNS
+from .reader import File
+
+
+class SizeIndex:
+    """Temporary on-disk table of file records fed while walking.
+
+    Only records of sizes shared by several files are read back, so memory
+    holds the collision groups rather than every file of the scan.
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="dedup-sizes-", suffix=".db")
+        os.close(fd)
+        self._db = sqlite3.connect(self.path)
+        # scratch data, rebuilt by every run
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute(
+            f"CREATE TABLE files (directory TEXT NOT NULL, {', '.join(COLUMNS)})"
+        )
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+        os.unlink(self.path)
+
+    def add(self, dir_cache):
+        """record the files of one directory cache"""
+        rows = [
+            (f.directory,) + f.to_row()
+            for f in dir_cache.values()
+            if isinstance(f, File) and f.size is not None
+        ]
+        self._db.executemany(
+            f"INSERT INTO files VALUES (?, {', '.join('?' * len(COLUMNS))})", rows
+        )
+        self.count += len(rows)
+
+    def groups(self) -> Iterator[List[File]]:
+        """files of every size shared by more than one file, size by size"""
+        self._db.commit()
+        cursor = self._db.execute(
+            f"SELECT directory, {', '.join(COLUMNS)} FROM files WHERE size IN ("
+            "SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1) ORDER BY size"
+        )
+        size = COLUMNS.index("size") + 1
+        for _, rows in itertools.groupby(cursor, key=lambda row: row[size]):
+            yield [File.from_row(row[1:], row[0]) for row in rows]
+
+    def batches(self, limit: int) -> Iterator[List[File]]:
+        """whole size groups, about limit files at a time"""
+        batch: List[File] = []
+        for group in self.groups():
+            batch += group
+            if len(batch) >= limit:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import pickle
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+from . import logger
+from .context import ctx
+
+# records pickled per call when writing a run
+_BATCH = 10000
+# open runs before they are merged into one
+FAN_IN = 64
+
+# file size, or (group number, digest): keys of one grouper are one kind
+Key = Union[int, Tuple[int, str]]
+
+
+def _read_run(run) -> Iterator[Tuple[Any, Any]]:
+    run.seek(0)
+    while True:
+        try:
+            yield from pickle.load(run)
+        except EOFError:
+            return
+
+
+class Grouper:
+    """Group (key, item) records by key, keeping only keys seen more than once.
+
+    Records are grouped in a dict until their estimated size passes
+    ctx.group_memory; from then on every full dict is written as a sorted run
+    to a temporary file and groups() merges the runs. More than FAN_IN runs
+    are merged into one, so the open files stay bounded. Either way groups
+    come out sorted by key with sorted items, so spilling never changes
+    results.
+    """
+
+    def __init__(self, budget: int = 0):
+        self.budget = budget or ctx.group_memory
+        self._groups: Dict[Key, List[Any]] = {}
+        self._count = 0
+        self._record_size = 0
+        self._runs: List[Any] = []
+
+    def add(self, key: Key, item):
+        if not self._record_size:
+            # per record: the key and item objects, a list slot, dict share
+            self._record_size = sys.getsizeof(key) + sys.getsizeof(item) + 64
+        self._groups.setdefault(key, []).append(item)
+        self._count += 1
+        if self._count * self._record_size > self.budget:
+            self._spill()
+
+    def _sorted(self) -> Iterator[Tuple[Key, Any]]:
+        for key in sorted(self._groups):
+            for item in sorted(self._groups[key]):
+                yield key, item
+
+    @staticmethod
+    def _write(records: Iterator[Tuple[Key, Any]]):
+        run = tempfile.TemporaryFile(prefix="dedup-run-")
+        while batch := list(itertools.islice(records, _BATCH)):
+            pickle.dump(batch, run, protocol=pickle.HIGHEST_PROTOCOL)
+        return run
+
+    def _spill(self):
+        self._runs.append(self._write(self._sorted()))
+        logger.debug(f"spilled run {len(self._runs)} of {self._count} records")
+        self._groups = {}
+        self._count = 0
+        if len(self._runs) > FAN_IN:
+            self._merge_runs()
+
+    def _merge_runs(self):
+        run = self._write(heapq.merge(*(_read_run(run) for run in self._runs)))
+        for merged in self._runs:
+            merged.close()
+        self._runs = [run]
+        logger.debug("merged spilled runs into one")
+
+    def groups(self) -> Iterator[Tuple[Key, List[Any]]]:
+        """(key, sorted items) of every key with more than one item, by key"""
+        try:
+            if not self._runs:
+                for key in sorted(self._groups):
+                    if len(self._groups[key]) > 1:
+                        yield key, sorted(self._groups[key])
+                return
+
+            merged = heapq.merge(
+                *(_read_run(run) for run in self._runs), self._sorted()
+            )
+            for key, records in itertools.groupby(merged, key=lambda r: r[0]):
+                items = [item for _, item in records]
+                if len(items) > 1:
+                    yield key, items
+        finally:
+            self.close()
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._groups = {}
+        self._count = 0
@@ -0,0 +1,183 @@
+import hashlib
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import cache
+from . import logger
+from .context import ctx
+from .reader import File
+from .walker import scan
+
+# ("identical", copies, files of each copy, bytes of one copy)
+# ("contained", [directory, container], files of directory, its bytes)
+Unit = Tuple[str, List[str], Dict[str, List[str]], int]
+
+
+def _under(path: str, directory: str) -> bool:
+    return path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class Trees:
+    """Merkle digests of directories whose every file has a copy.
+
+    A directory digest covers the group keys of its files and the digests
+    of its subdirectories, so a copied folder gets the digest of its
+    original wherever it sits, under any name unless ctx.tree_names is set.
+    No file is read again: keys come from the duplicate groups, listings
+    from the directory caches, and every directory is digested once.
+    """
+
+    def __init__(self, dups: Dict[str, List[str]], roots: List[str], directories=None):
+        self.dups = dups
+        self.roots = roots
+        self.key = {f: key for key, filenames in dups.items() for f in filenames}
+        self.directories = directories or {}
+        self.digests: Dict[str, Optional[str]] = {}
+        self.files: Dict[str, List[str]] = {}  # subtree files of digested dirs
+        self.subdirs: Dict[str, List[str]] = {}  # of digested dirs
+        self.sizes: Dict[str, int] = {}
+
+    def _cache(self, directory: str):
+        dir_cache = self.directories.get(directory)
+        if dir_cache is None:
+            dir_cache = cache.load(directory)
+        return dir_cache
+
+    def _entry(self, kind: str, name: str, digest: str) -> str:
+        if ctx.tree_names:
+            return f"{kind}:{digest}:{name}"
+        return f"{kind}:{digest}"
+
+    def digest(self, directory: str) -> Optional[str]:
+        """digest of the subtree, None when a file in it has no copy"""
+        if directory in self.digests:
+            return self.digests[directory]
+        self.digests[directory] = None
+        dir_cache = self._cache(directory)
+        entries = []
+        files = []
+        for filename, file_obj in dir_cache.items():
+            if not isinstance(file_obj, File):
+                continue
+            key = self.key.get(filename)
+            if key is None:
+                return None
+            entries.append(self._entry("f", file_obj.name, key))
+            files.append(filename)
+            self.sizes[filename] = file_obj.size
+
+        subdirs = dir_cache.subdirs
+        if not dir_cache.entry_count:
+            # cache written without a listing
+            try:
+                subdirs = scan(directory)[0]
+            except OSError as e:
+                logger.warning(f"unable to list {directory}: {e}")
+                return None
+        for name in subdirs:
+            subdir = os.path.join(directory, name)
+            sub_digest = self.digest(subdir)
+            if sub_digest is None:
+                return None
+            entries.append(self._entry("d", name, sub_digest))
+            files += self.files[subdir]
+
+        if not files:
+            # empty trees are equal to each other, not worth a decision
+            return None
+        entries.sort()
+        digest = hashlib.md5("\n".join(entries).encode()).hexdigest()
+        self.digests[directory] = digest
+        self.files[directory] = files
+        self.subdirs[directory] = [os.path.join(directory, name) for name in subdirs]
+        return digest
+
+    def size(self, directory: str) -> int:
+        return sum(self.sizes[f] for f in self.files[directory])
+
+    def _scanned(self, directory: str) -> bool:
+        return any(directory == root or _under(directory, root) for root in self.roots)
+
+    def find(self) -> List[Unit]:
+        """largest identical and contained subtrees, biggest first"""
+        # parents of directories with duplicates are digested on the way up
+        for filename in self.key:
+            directory = os.path.dirname(filename)
+            while directory not in self.digests and self._scanned(directory):
+                self.digest(directory)
+                directory = os.path.dirname(directory)
+
+        by_digest = defaultdict(list)
+        for directory, digest in self.digests.items():
+            if digest:
+                by_digest[digest].append(directory)
+        copied = {digest for digest, dirs in by_digest.items() if len(dirs) > 1}
+
+        contained: Dict[str, str] = {}
+
+        def unit(directory):
+            return self.digests.get(directory) in copied or directory in contained
+
+        def covered(directory):
+            # the parent is a unit of its own already
+            return unit(os.path.dirname(directory))
+
+        def wrapper(directory):
+            # only holds units, which are decided on their own
+            own = len(self.files[directory]) - sum(
+                len(self.files[d]) for d in self.subdirs[directory]
+            )
+            return not own and all(unit(d) for d in self.subdirs[directory])
+
+        # deepest first, a wrapper is known by its subdirectories
+        for directory in sorted(self.files, reverse=True):
+            if self.digests[directory] in copied or wrapper(directory):
+                continue
+            container = self._container(directory)
+            if container is not None:
+                contained[directory] = container
+
+        units: List[Unit] = []
+        for digest in copied:
+            dirs = sorted(by_digest[digest])
+            # once the covering units are decided at most one copy is left
+            if sum(not covered(d) for d in dirs) > 1:
+                files = {d: self.files[d] for d in dirs}
+                units.append(("identical", dirs, files, self.size(dirs[0])))
+        for directory, container in contained.items():
+            if not covered(directory):
+                units.append(
+                    (
+                        "contained",
+                        [directory, container],
+                        {directory: self.files[directory]},
+                        self.size(directory),
+                    )
+                )
+        units.sort(key=lambda unit: (-unit[3], unit[1]))
+        return units
+
+    def _container(self, directory: str) -> Optional[str]:
+        """deepest directory outside directory holding a copy of each file"""
+        holders: Optional[Set[str]] = None
+        for filename in self.files[directory]:
+            places = set()
+            for copy in self.dups[self.key[filename]]:
+                if _under(copy, directory):
+                    continue
+                place = os.path.dirname(copy)
+                while place not in places:
+                    places.add(place)
+                    parent = os.path.dirname(place)
+                    if parent == place:
+                        break
+                    place = parent
+            holders = places if holders is None else holders & places
+            # ancestors hold the directory itself
+            holders = {h for h in holders if not _under(directory, h)}
+            if not holders:
+                return None
+        if not holders:
+            return None
+        return max(sorted(holders), key=len)
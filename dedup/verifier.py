@@ -0,0 +1,77 @@
+import os
+from typing import Dict, List, Tuple
+
+from . import logger
+from .reader import File, FileReader
+
+
+def _read_exact(fi, buffer: bytearray) -> memoryview:
+    """fill buffer unless the file ends first, the part read"""
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view):
+        n = fi.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return view[:filled]
+
+
+def identical(files: List[File]) -> List[List[File]]:
+    """Split same-size files into groups of byte-identical content.
+
+    All files are read together chunk by chunk. A group splits as soon as
+    its chunks differ and a file left without a peer is closed, so files
+    that diverge early cost one chunk instead of a full read.
+    """
+    handles = {}
+    try:
+        for file_obj in files:
+            try:
+                handles[file_obj] = FileReader.open(file_obj.filename)
+                FileReader.advise(handles[file_obj], 0, 0, "SEQUENTIAL")
+            except OSError as e:
+                logger.warning(f"unable to compare {file_obj.filename}: {e}")
+        if len(handles) < 2:
+            return []
+        first = os.fstat(next(iter(handles.values())).fileno())
+        chunk = FileReader.chunk_size(first.st_size)
+        # one buffer per file, refilled every round
+        buffers: Dict[File, bytearray] = {f: bytearray(chunk) for f in handles}
+
+        def close(group):
+            for file_obj in group:
+                FileReader.close(handles.pop(file_obj))
+
+        same = []
+        active = [list(handles)]
+        while active:
+            next_active = []
+            for group in active:
+                buckets: List[Tuple[memoryview, List[File]]] = []  # few per group
+                for file_obj in group:
+                    try:
+                        data = _read_exact(handles[file_obj], buffers[file_obj])
+                    except OSError as e:
+                        logger.warning(f"unable to compare {file_obj.filename}: {e}")
+                        close([file_obj])
+                        continue
+                    for bucket_data, bucket in buckets:
+                        if bucket_data == data:
+                            bucket.append(file_obj)
+                            break
+                    else:
+                        buckets.append((data, [file_obj]))
+                for data, bucket in buckets:
+                    if len(bucket) < 2:
+                        close(bucket)
+                    elif not data:
+                        same.append(bucket)
+                        close(bucket)
+                    else:
+                        next_active.append(bucket)
+            active = next_active
+        return same
+    finally:
+        for fi in handles.values():
+            FileReader.close(fi)
@@ -1,25 +1,64 @@
 import os
+import random
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import List, Tuple
 
 from . import logger
 
 from .context import ctx
 from .reader import File
 from . import cache
-from .misc import to_abs
+
+
+def scan(directory: str) -> Tuple[List[str], List[os.DirEntry]]:
+    """list a directory: visible subdirectory names and file entries
+
+    dot-directories, symlinks and cache files are pruned here, so nothing
+    below them is ever listed.
+    """
+    dirs = []
+    files = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                if not entry.name.startswith("."):
+                    dirs.append(entry.name)
+            elif not entry.name.startswith(ctx.cache_filename):
+                files.append(entry)
+    dirs.sort()
+    files.sort(key=lambda e: e.name)
+    return dirs, files
 
 
 class Walker:
     def directories(self, dir_name: str):
-        for current_dir, dirs, files in os.walk(dir_name):
-            if os.path.basename(current_dir).startswith("."):
-                continue
+        stack = [str(Path(dir_name).resolve())]
+        while stack:
+            current_dir = stack.pop()
             yield current_dir
+            try:
+                dirs, _files = scan(current_dir)
+            except OSError as e:
+                logger.warning(f"unable to list {current_dir}: {e}")
+                continue
+            stack.extend(os.path.join(current_dir, d) for d in reversed(dirs))
 
     def build(self, dir_name: str):
         """wall through the FS and scan files
         return dict of all files
         """
+        return self.build_all([dir_name])
+
+    def build_all(self, dir_names: List[str], sink=None):
+        """scan several roots, ctx.walk_jobs threads share one directory queue
+        return dict of all files and dict of directory caches
+
+        with sink, every directory cache is passed to sink(cache) as soon as
+        it is mapped and nothing is kept, both dicts come back empty.
+        """
         progress_file = None
         progress_data = set()
         if ctx.rerun:
@@ -36,59 +75,177 @@ class Walker:
             progress_file = ctx.progress_filename.open(encoding="utf-8", mode="w")
 
         try:
-            counter = 0
+            # resolve the roots once, children are joined below them
+            roots = []
+            for dir_name in dir_names:
+                resolved_dir = str(Path(dir_name).resolve())
+                if resolved_dir not in roots:
+                    logger.info(f"reading file system {resolved_dir}")
+                    roots.append(resolved_dir)
+
+            mapped = {}  # directory: (subdirectories, cache)
+
+            def done(current_dir, result):
+                dirs, dir_cache, completed = result
+                if sink is not None:
+                    if dir_cache is not None:
+                        sink(dir_cache)
+                    dir_cache = None
+                mapped[current_dir] = (dirs, dir_cache)
+                if completed and progress_file:
+                    progress_file.write(current_dir + "\n")
+                    progress_file.flush()
+                return [
+                    d
+                    for d in (os.path.join(current_dir, name) for name in dirs)
+                    if d not in mapped
+                ]
+
+            if ctx.walk_jobs > 1:
+                self._walk_parallel(roots, progress_data, done)
+            else:
+                stack = list(reversed(roots))
+                while stack:
+                    current_dir = stack.pop()
+                    if current_dir in mapped:
+                        continue
+                    result = self._map_directory(current_dir, progress_data)
+                    stack.extend(reversed(done(current_dir, result)))
+
+            # assemble in depth-first order, whatever order workers finished in
             accomulator = {}
             directories = {}
-            resolved_dir = Path(dir_name).resolve()
-            logger.info(f"reading file system {resolved_dir}")
-            for current_dir, dirs, files in os.walk(resolved_dir):
-                # process single directory
-                if os.path.basename(current_dir).startswith("."):
-                    continue
-                current_dir = str(Path(current_dir).resolve())
-                old_cache = cache.load(current_dir)
-                if old_cache and current_dir in progress_data:
-                    directories[current_dir] = old_cache
-                    accomulator.update(old_cache)
-                    logger.warning(f"cached: {current_dir}")
+            stack = list(reversed(roots))
+            while stack:
+                current_dir = stack.pop()
+                if current_dir in directories or current_dir not in mapped:
                     continue
-                logger.ok(f"mapping {current_dir}")
-                new_cache = cache.new(current_dir)
-                cache_changed = False
-                exception = False
-                for file in files:
-                    if file == ctx.cache_filename:
-                        continue
-                    counter += 1
-
-                    filename = to_abs(os.path.join(current_dir, file))
-
-                    if filename in old_cache:
-                        file_obj = File.from_cache(old_cache.get(filename))
-                        cache_changed = cache_changed or not file_obj.hashed
-                    else:
-                        file_obj = File(filename, current_dir)
-                        cache_changed = True
-                    new_cache[filename] = file_obj
-
-                    # only populate stat (hashing deferred to size-collision check)
-                    try:
-                        file_obj.ensure_stat()
-                    except Exception:
-                        logger.warning(f"unable to stat file {filename}")
-                        exception = True
-                        continue
-
-                if cache_changed:
-                    if not exception:
-                        if progress_file:
-                            progress_file.write(current_dir + "\n")
-                            progress_file.flush()
-                    new_cache.store()
-
-                directories[current_dir] = new_cache
-                accomulator.update(new_cache)
+                dirs, dir_cache = mapped[current_dir]
+                if dir_cache is not None:
+                    directories[current_dir] = dir_cache
+                    accomulator.update(dir_cache)
+                stack.extend(os.path.join(current_dir, d) for d in reversed(dirs))
+            cache.commit()
             return accomulator, directories
         finally:
             if progress_file:
                 progress_file.close()
+
+    def _walk_parallel(self, roots: List[str], progress_data, done):
+        with ThreadPoolExecutor(max_workers=ctx.walk_jobs) as executor:
+            queued = set(roots)
+            running = {
+                executor.submit(self._map_directory, d, progress_data): d for d in roots
+            }
+            try:
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        current_dir = running.pop(future)
+                        for d in done(current_dir, future.result()):
+                            if d not in queued:
+                                queued.add(d)
+                                running[
+                                    executor.submit(
+                                        self._map_directory, d, progress_data
+                                    )
+                                ] = d
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def _map_directory(self, current_dir: str, progress_data):
+        """list and stat one directory
+        return (subdirectory names, cache or None, completed for progress file)
+        """
+        try:
+            dir_stat = os.stat(current_dir)
+        except OSError as e:
+            logger.warning(f"unable to stat {current_dir}: {e}")
+            return [], None, False
+
+        old_cache = cache.load(current_dir)
+        listed = old_cache.listing_valid(dir_stat)
+        if old_cache and current_dir in progress_data:
+            logger.warning(f"cached: {current_dir}")
+            if listed:
+                return old_cache.subdirs, old_cache, False
+            try:
+                return scan(current_dir)[0], old_cache, False
+            except OSError as e:
+                logger.warning(f"unable to list {current_dir}: {e}")
+                return [], None, False
+
+        if listed:
+            rescanned = self._rescan(current_dir, old_cache)
+            if rescanned is not None:
+                return rescanned
+
+        try:
+            dirs, files = scan(current_dir)
+        except OSError as e:
+            logger.warning(f"unable to list {current_dir}: {e}")
+            return [], None, False
+
+        logger.ok(f"mapping {current_dir}")
+        new_cache = cache.new(current_dir)
+        new_cache.set_listing(dir_stat, dirs, len(dirs) + len(files))
+        cache_changed = not listed and bool(dirs or files)
+        exception = False
+        for entry in files:
+            filename = os.path.join(current_dir, entry.name)
+            try:
+                # reuse the stat the directory entry already holds
+                st = entry.stat()
+            except OSError:
+                logger.warning(f"unable to stat file {filename}")
+                exception = True
+                continue
+
+            if filename in old_cache:
+                file_obj = File.from_cache(old_cache.get(filename), st)
+                cache_changed = cache_changed or not file_obj.hashed
+            else:
+                file_obj = File(filename, current_dir)
+                file_obj.set_stat(st)
+                cache_changed = True
+            new_cache[filename] = file_obj
+
+        if cache_changed:
+            new_cache.store()
+        return dirs, new_cache, cache_changed and not exception
+
+    def _rescan(self, current_dir: str, old_cache):
+        """reuse the cached listing of a directory whose mtime did not change,
+        files are checked as ctx.rescan_policy says
+        return None when the directory has to be scanned again
+        """
+        files = list(old_cache.values())
+        if ctx.rescan_policy == "trust":
+            checked = []
+        elif ctx.rescan_policy == "sample":
+            checked = random.sample(files, min(len(files), ctx.rescan_sample))
+        else:
+            checked = files
+
+        logger.debug(f"unchanged {current_dir}")
+        new_cache = cache.new(current_dir)
+        new_cache.copy_listing(old_cache)
+        new_cache.update(old_cache)
+        cache_changed = False
+        for old in checked:
+            try:
+                st = os.stat(old.filename)
+            except OSError:
+                return None
+            if old.same_stat(st):
+                continue
+            if ctx.rescan_policy == "sample":
+                # one changed file is enough to distrust the rest
+                return None
+            new_cache[old.filename] = File.from_cache(old, st)
+            cache_changed = True
+
+        if cache_changed:
+            new_cache.store()
+        return old_cache.subdirs, new_cache, cache_changed
@@ -1,5 +1,6 @@
 import pytest
 
+from dedup import index
 from dedup.context import ctx
 
 
@@ -50,8 +51,32 @@ def reset_ctx():
         "rerun": ctx.rerun,
         "dirs": ctx.dirs,
         "unlink": ctx.unlink,
+        "cache_flush_interval": ctx.cache_flush_interval,
+        "journal_sync_interval": ctx.journal_sync_interval,
+        "tree_names": ctx.tree_names,
+        "two_phase": ctx.two_phase,
+        "journal_compact_entries": ctx.journal_compact_entries,
+        "index_path": ctx.index_path,
+        "rescan_policy": ctx.rescan_policy,
+        "listing_grace_ns": ctx.listing_grace_ns,
         "large_file_threshold": ctx.large_file_threshold,
         "partial_hash_size": ctx.partial_hash_size,
+        "head_hash_size": ctx.head_hash_size,
+        "hash_algo": ctx.hash_algo,
+        "filter_algo": ctx.filter_algo,
+        "use_mmap": ctx.use_mmap,
+        "mmap_threshold": ctx.mmap_threshold,
+        "gentle_io": ctx.gentle_io,
+        "verify": ctx.verify,
+        "compare_max_open": ctx.compare_max_open,
+        "jobs": ctx.jobs,
+        "pool": ctx.pool,
+        "walk_jobs": ctx.walk_jobs,
+        "stream": ctx.stream,
+        "stream_batch": ctx.stream_batch,
+        "group_memory": ctx.group_memory,
+        "columnar": ctx.columnar,
+        "rotational_jobs": ctx.rotational_jobs,
     }
 
     ctx.verbose = False
@@ -59,11 +84,36 @@ def reset_ctx():
     ctx.rerun = False
     ctx.dirs = []
     ctx.unlink = False
+    ctx.cache_flush_interval = 30.0
+    ctx.journal_sync_interval = 1.0
+    ctx.tree_names = False
+    ctx.two_phase = False
+    ctx.journal_compact_entries = 10000
+    ctx.index_path = None
+    ctx.rescan_policy = "stat"
+    ctx.listing_grace_ns = 2 * 10**9
     ctx.large_file_threshold = 100 * 1024 * 1024  # 100MB default
     ctx.partial_hash_size = 10 * 1024 * 1024  # 10MB default
+    ctx.head_hash_size = 4 * 1024  # 4KB default
+    ctx.hash_algo = "md5"
+    ctx.filter_algo = None
+    ctx.use_mmap = False
+    ctx.mmap_threshold = 64 * 1024 * 1024
+    ctx.gentle_io = False
+    ctx.verify = "compare"
+    ctx.compare_max_open = 64
+    ctx.jobs = 1
+    ctx.pool = "thread"
+    ctx.walk_jobs = 1
+    ctx.stream = False
+    ctx.stream_batch = 100_000
+    ctx.group_memory = 512 * 1024 * 1024
+    ctx.columnar = False
+    ctx.rotational_jobs = 1
 
     yield ctx
 
+    index.close()
     for k, v in original.items():
         setattr(ctx, k, v)
 
@@ -1,5 +1,9 @@
+import os
 import time
 
+import pytest
+
+from dedup import colander
 from dedup.processor import Processor
 from dedup.context import ctx
 
@@ -400,6 +404,95 @@ class TestDedupRemoval:
         assert len(dups2) == 0
 
 
+class TestTwoPhaseDecisions:
+    def _tree(self, temp_tree):
+        for name in ("dir_a", "dir_b", "dir_c", "dir_d"):
+            (temp_tree / name).mkdir()
+        # decided by the rules
+        (temp_tree / "dir_a" / "ruled.txt").write_bytes(b"ruled")
+        (temp_tree / "dir_b" / "ruled.txt").write_bytes(b"ruled")
+        # left for the operator, small and big
+        (temp_tree / "dir_c" / "small.txt").write_bytes(b"small")
+        (temp_tree / "dir_d" / "small.txt").write_bytes(b"small")
+        (temp_tree / "dir_c" / "big.bin").write_bytes(b"B" * 1000)
+        (temp_tree / "dir_d" / "big.bin").write_bytes(b"B" * 1000)
+        ctx.appraiser_rules_filename.write_text(f"5:{temp_tree / 'dir_a'}\n")
+
+    def test_rules_first_then_biggest_prompt(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """Only undecided groups are prompted, the biggest savings first."""
+        reset_ctx.rerun = True
+        reset_ctx.two_phase = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.jobs = 2
+        monkeypatch.setattr(colander, "DECIDE_CHUNK", 1)
+        self._tree(temp_tree)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+        assert len(dups) == 3
+
+        # leave the first prompted group, keep dir_c in the second
+        inputs = iter(["+", "0"])
+        monkeypatch.setattr("builtins.input", lambda _: next(inputs))
+
+        files_to_delete = processor.press.squeeze_redundant(dups)
+
+        assert sorted(files_to_delete) == [
+            str(temp_tree / "dir_b" / "ruled.txt"),
+            str(temp_tree / "dir_d" / "small.txt"),
+        ]
+        assert ctx.decisions_filename.exists()
+
+    def test_rerun_reuses_decisions(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.rerun = True
+        reset_ctx.two_phase = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._tree(temp_tree)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+        decided = processor.press.predecide(list(dups.values()))
+
+        def decide(self, files):
+            raise AssertionError("decided again")
+
+        monkeypatch.setattr("dedup.appraiser.Appraiser.decide", decide)
+        assert colander.Press().predecide(list(dups.values())) == decided
+        assert len(decided[1]) == 2
+
+    def test_rules_before_tree_prompts(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """No tree is offered before the rules have decided every group."""
+        reset_ctx.rerun = True
+        reset_ctx.two_phase = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._tree(temp_tree)
+        events = []
+        # keep dir_c as a whole, then refuse the removal
+        inputs = iter(["0", "no"])
+        predecide = colander.Press.predecide
+
+        def recorded(self, groups):
+            events.append("predecide")
+            return predecide(self, groups)
+
+        def prompt(_):
+            events.append("input")
+            return next(inputs)
+
+        monkeypatch.setattr(colander.Press, "predecide", recorded)
+        monkeypatch.setattr("builtins.input", prompt)
+
+        Processor([str(temp_tree)]).dedup()
+
+        assert events == ["predecide", "input", "input"]
+
+
 class TestMoveToNewDirectory:
     def test_move_duplicate_to_new_location(
         self, temp_tree, reset_ctx, working_dir, monkeypatch
@@ -477,6 +570,57 @@ class TestMoveToNewDirectory:
         assert str(target_dir) in dst
 
 
+class TestBatchDecisions:
+    def _copied_folder(self, temp_tree):
+        dir_a = temp_tree / "dir_a"
+        dir_b = temp_tree / "dir_b"
+        dir_a.mkdir()
+        dir_b.mkdir()
+        for i in range(3):
+            (dir_a / f"file{i}.txt").write_bytes(f"content {i}".encode())
+            (dir_b / f"file{i}.txt").write_bytes(f"content {i}".encode())
+        return dir_a, dir_b
+
+    def test_keep_applied_to_all_groups(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """One starred answer decides every group from the same directories."""
+        dir_a, dir_b = self._copied_folder(temp_tree)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+        assert len(dups) == 3
+
+        # keep the dir_b copy (second in sorted order) for all groups
+        inputs = iter(["1*"])
+        monkeypatch.setattr("builtins.input", lambda _: next(inputs))
+
+        files_to_delete = processor.press.squeeze_redundant(dups)
+
+        assert sorted(files_to_delete) == sorted(
+            str(dir_a / f"file{i}.txt") for i in range(3)
+        )
+
+    def test_leave_all_recorded_as_answers(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """Auto-applied groups are saved to the answers file."""
+        dir_a, dir_b = self._copied_folder(temp_tree)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        inputs = iter(["+*"])
+        monkeypatch.setattr("builtins.input", lambda _: next(inputs))
+
+        files_to_delete = processor.press.squeeze_redundant(dups)
+        processor.press.close()
+
+        assert files_to_delete == []
+        answers = ctx.answers_filename.read_text().split()
+        assert len(answers) == 6
+
+
 class TestActualFileOperations:
     def test_files_actually_deleted(
         self, temp_tree, reset_ctx, working_dir, monkeypatch
@@ -635,6 +779,29 @@ class TestStatsCommand:
         capsys.readouterr()
         # output goes to logger, not stdout, but no exception = success
 
+    def test_sparse_copy_matches_dense(self, temp_tree, reset_ctx, working_dir):
+        """A sparse file and its dense copy are duplicates, disk usage differs."""
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 16
+
+        size = 4 * 1024 * 1024
+        with open(temp_tree / "sparse.img", "wb") as fo:
+            fo.write(b"header")
+            fo.truncate(size)
+        (temp_tree / "dense.img").write_bytes(b"header" + bytes(size - 6))
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        assert len(dups) == 1
+        sparse = files[str(temp_tree / "sparse.img")]
+        if not sparse.sparse:
+            pytest.skip("filesystem does not keep holes")
+        dense = files[str(temp_tree / "dense.img")]
+        assert processor.reclaimable(files, dups) == size
+        assert processor.reclaimable(files, dups, allocated=True) == dense.allocated
+
 
 class TestPurgeOptions:
     def test_purge_list_option(self, temp_tree, reset_ctx, working_dir, monkeypatch):
@@ -715,6 +882,23 @@ class TestPurgeOptions:
 
 
 class TestCheckpointRerun:
+    def test_stale_rules_journal_dropped_by_new_session(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """stats keeps a crashed session's journal, a new dedup drops it."""
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        (temp_tree / "file1.txt").write_bytes(b"duplicate")
+        (temp_tree / "file2.txt").write_bytes(b"duplicate")
+        ctx.rules_journal_filename.write_text("5:/crashed\n")
+
+        Processor([str(temp_tree)]).stats()
+        assert ctx.rules_journal_filename.exists()
+
+        inputs = iter(["+", "no"])
+        monkeypatch.setattr("builtins.input", lambda _: next(inputs))
+        Processor([str(temp_tree)]).dedup()
+        assert not ctx.rules_journal_filename.exists()
+
     def test_rerun_loads_checkpoint(
         self, temp_tree, reset_ctx, working_dir, monkeypatch
     ):
@@ -811,6 +995,601 @@ class TestLargeFileVerification:
         assert len(dups) == 1
         assert len(list(dups.values())[0]) == 2
 
+    def test_large_files_compared_without_full_hash(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """Large candidates are compared byte by byte, not hashed in full."""
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.large_file_threshold = 50
+        reset_ctx.partial_hash_size = 10
+
+        same = b"A" * 40 + b"B" * 20 + b"C" * 40
+        (temp_tree / "large1.txt").write_bytes(same)
+        (temp_tree / "large2.txt").write_bytes(same)
+        # same sampled segments, differs between them
+        (temp_tree / "large3.txt").write_bytes(b"A" * 40 + b"X" * 20 + b"C" * 40)
+
+        from dedup.reader import FileReader
+
+        def fail(*args):
+            raise AssertionError("large files should not be hashed in full")
+
+        monkeypatch.setattr(FileReader, "_hash_full_file", staticmethod(fail))
+        _, dups = Processor([str(temp_tree)]).calculus()
+
+        assert [sorted(os.path.basename(f) for f in g) for g in dups.values()] == [
+            ["large1.txt", "large2.txt"]
+        ]
+
+    def test_verify_hash_keeps_full_digests(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.large_file_threshold = 50
+        reset_ctx.partial_hash_size = 10
+        reset_ctx.verify = "hash"
+
+        (temp_tree / "large1.txt").write_bytes(b"A" * 100)
+        (temp_tree / "large2.txt").write_bytes(b"A" * 100)
+
+        files, dups = Processor([str(temp_tree)]).calculus()
+
+        assert list(dups) == [next(iter(files.values())).digest("full")]
+
+
+class TestStagedHashing:
+    def test_different_heads_never_fully_hashed(
+        self, temp_tree, reset_ctx, working_dir
+    ):
+        """Same-size files differing in the first block stop at the head stage."""
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 16
+
+        (temp_tree / "a.raw").write_bytes(b"A" * 16 + b"same tail" * 10)
+        (temp_tree / "b.raw").write_bytes(b"B" * 16 + b"same tail" * 10)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        assert len(dups) == 0
+        for file_obj in files.values():
+            assert file_obj.digest("head")
+            assert file_obj.digest("sample") is None
+            assert not file_obj.hashed
+
+    def test_different_tails_stop_at_sample(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 16
+
+        (temp_tree / "a.raw").write_bytes(b"H" * 100 + b"tail one")
+        (temp_tree / "b.raw").write_bytes(b"H" * 100 + b"tail two")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        assert len(dups) == 0
+        for file_obj in files.values():
+            assert file_obj.digest("sample")
+            assert not file_obj.hashed
+
+    def test_cached_full_digests_skip_early_stages(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 16
+
+        content = b"X" * 200
+        (temp_tree / "a.raw").write_bytes(content)
+        (temp_tree / "b.raw").write_bytes(content)
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+        assert len(dups) == 1
+
+        from dedup.reader import FileReader
+
+        for file_obj in files.values():
+            file_obj.digests = (None, None, file_obj.digest("full"))
+
+        def fail(*args):
+            raise AssertionError("cached digests should be reused")
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(fail))
+        assert processor._duplicates(files) == dups
+
+
+class TestHashWriteBack:
+    def test_hashes_persisted_to_directory_cache(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        """Digests computed while finding duplicates survive to the next run."""
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+
+        sub = temp_tree / "sub"
+        sub.mkdir()
+        (temp_tree / "a.txt").write_bytes(b"persisted content")
+        (sub / "b.txt").write_bytes(b"persisted content")
+
+        _, dups1 = Processor([str(temp_tree)]).calculus()
+
+        from dedup.reader import FileReader
+
+        def fail(*args):
+            raise AssertionError("digests should come from the cache")
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(fail))
+        _, dups2 = Processor([str(temp_tree)]).calculus()
+
+        assert len(dups2) == 1
+        assert dups1 == dups2
+
+    def test_interrupt_keeps_completed_stages(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 16
+
+        (temp_tree / "a.bin").write_bytes(b"H" * 100)
+        (temp_tree / "b.bin").write_bytes(b"H" * 100)
+
+        from dedup import cache
+        from dedup.reader import FileReader
+
+        original = FileReader.digest
+
+        def interrupt_full(filename, stage):
+            if stage == "full":
+                raise KeyboardInterrupt()
+            return original(filename, stage)
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(interrupt_full))
+        with pytest.raises(KeyboardInterrupt):
+            Processor([str(temp_tree)]).calculus()
+
+        stored = cache.load(str(temp_tree))
+        assert len(stored) == 2
+        for file_obj in stored.values():
+            assert file_obj.digest("head")
+            assert file_obj.digest("sample")
+            assert not file_obj.hashed
+
+
+class TestCentralIndex:
+    def test_index_replaces_cache_files(
+        self, duplicate_tree, tmp_path, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.index_path = tmp_path / "index.db"
+
+        _, dups1 = Processor([str(duplicate_tree)]).calculus()
+
+        assert len(dups1) == 2
+        assert not list(duplicate_tree.rglob(reset_ctx.cache_filename))
+
+        from dedup.reader import FileReader
+
+        def fail(*args):
+            raise AssertionError("digests should come from the index")
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(fail))
+        _, dups2 = Processor([str(duplicate_tree)]).calculus()
+
+        assert dups1 == dups2
+
+    def test_collisions_queried_from_index(
+        self, duplicate_tree, tmp_path, reset_ctx, working_dir, monkeypatch
+    ):
+        """Fully hashed sizes are grouped by the index, not sieved again."""
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.index_path = tmp_path / "index.db"
+
+        _, dups1 = Processor([str(duplicate_tree)]).calculus()
+
+        def fail(*args):
+            raise AssertionError("grouped in memory")
+
+        monkeypatch.setattr(Processor, "_size_groups", fail)
+        monkeypatch.setattr(Processor, "_compared", fail)
+        _, dups2 = Processor([str(duplicate_tree)]).calculus()
+
+        assert len(dups2) == 2
+        assert dups1 == dups2
+
+
+class TestUnchangedDirectories:
+    def _scan_twice(self, temp_tree, reset_ctx, monkeypatch, policy, change):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.listing_grace_ns = 0
+        reset_ctx.rescan_policy = policy
+
+        (temp_tree / "sub").mkdir()
+        (temp_tree / "a.txt").write_bytes(b"original")
+        (temp_tree / "sub" / "b.txt").write_bytes(b"other")
+
+        from dedup import walker
+
+        walker.Walker().build(str(temp_tree))
+        change()
+
+        listed = []
+        original_scan = walker.scan
+
+        def counting_scan(directory):
+            listed.append(directory)
+            return original_scan(directory)
+
+        monkeypatch.setattr(walker, "scan", counting_scan)
+        files, _ = walker.Walker().build(str(temp_tree))
+        return files, listed
+
+    def test_unchanged_directories_not_listed(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        files, listed = self._scan_twice(
+            temp_tree, reset_ctx, monkeypatch, "stat", lambda: None
+        )
+
+        assert listed == []
+        assert len(files) == 2
+
+    def test_stat_policy_detects_content_change(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        target = temp_tree / "a.txt"
+        files, listed = self._scan_twice(
+            temp_tree,
+            reset_ctx,
+            monkeypatch,
+            "stat",
+            lambda: target.write_bytes(b"changed and longer"),
+        )
+
+        assert listed == []
+        assert files[str(target)].size == len(b"changed and longer")
+
+    def test_trust_policy_keeps_cached_stat(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        target = temp_tree / "a.txt"
+        files, listed = self._scan_twice(
+            temp_tree,
+            reset_ctx,
+            monkeypatch,
+            "trust",
+            lambda: target.write_bytes(b"changed and longer"),
+        )
+
+        assert listed == []
+        assert files[str(target)].size == len(b"original")
+
+    def test_sample_policy_falls_back_to_listing(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        target = temp_tree / "a.txt"
+        files, listed = self._scan_twice(
+            temp_tree,
+            reset_ctx,
+            monkeypatch,
+            "sample",
+            lambda: target.write_bytes(b"changed and longer"),
+        )
+
+        assert listed == [str(temp_tree.resolve())]
+        assert files[str(target)].size == len(b"changed and longer")
+
+    def test_new_file_changes_directory(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        def add_file():
+            (temp_tree / "sub" / "new.txt").write_bytes(b"new")
+            # make sure the directory mtime moves on coarse clocks
+            st = (temp_tree / "sub").stat()
+            os.utime(temp_tree / "sub", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        files, listed = self._scan_twice(
+            temp_tree, reset_ctx, monkeypatch, "stat", add_file
+        )
+
+        assert listed == [str((temp_tree / "sub").resolve())]
+        assert len(files) == 3
+
+
+class TestHardlinks:
+    def test_links_hashed_once_and_collapsed(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+
+        content = b"linked content"
+        (temp_tree / "a.txt").write_bytes(content)
+        os.link(temp_tree / "a.txt", temp_tree / "a_link.txt")
+        (temp_tree / "b.txt").write_bytes(content)
+
+        from dedup.reader import FileReader
+
+        hashed = []
+        original = FileReader.digest
+
+        def counting_digest(filename, stage):
+            hashed.append(filename)
+            return original(filename, stage)
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(counting_digest))
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        assert len(hashed) == 2
+        assert len(dups) == 1
+        [group] = dups.values()
+        assert len(group) == 2
+        assert str(temp_tree / "b.txt") in group
+        # the skipped link still gets the digest for the cache
+        assert files[str(temp_tree / "a_link.txt")].hashed
+        # deleting the listed path of a linked inode frees nothing
+        assert processor.reclaimable(files, dups) == len(content)
+
+    def test_links_alone_are_not_duplicates(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+
+        (temp_tree / "a.txt").write_bytes(b"only links")
+        os.link(temp_tree / "a.txt", temp_tree / "a_link.txt")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        assert dups == {}
+        assert processor.reclaimable(files, dups) == 0
+
+    def test_reclaimable_counts_copies(self, duplicate_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+
+        processor = Processor([str(duplicate_tree)])
+        files, dups = processor.calculus()
+
+        assert processor.reclaimable(files, dups) == len(
+            b"duplicate content here"
+        ) + len(b"another duplicate")
+
+
+class TestDirectoryTrees:
+    def _album(self, directory, names=("x.jpg", "y.jpg")):
+        (directory / "sub").mkdir(parents=True)
+        (directory / names[0]).write_bytes(b"photo one")
+        (directory / "sub" / names[1]).write_bytes(b"photo two")
+
+    def test_identical_trees_found(self, temp_tree, reset_ctx, working_dir):
+        """A copied folder is one unit, not a group per file."""
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._album(temp_tree / "album")
+        self._album(temp_tree / "backup" / "album copy", names=("a.jpg", "b.jpg"))
+        (temp_tree / "unique.txt").write_bytes(b"unique")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+        assert len(dups) == 2
+
+        units = processor.trees(dups)
+
+        album = str(temp_tree / "album")
+        copy = str(temp_tree / "backup" / "album copy")
+        assert [(kind, dirs, size) for kind, dirs, _, size in units] == [
+            ("identical", [album, copy], len(b"photo one") + len(b"photo two")),
+        ]
+        assert len(units[0][2][copy]) == 2
+
+        # names count: the renamed copy no longer matches
+        reset_ctx.tree_names = True
+        assert all(kind == "contained" for kind, *_ in processor.trees(dups))
+
+    def test_contained_tree_found(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._album(temp_tree / "album")
+        self._album(temp_tree / "all")
+        (temp_tree / "all" / "more.jpg").write_bytes(b"photo three")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        units = processor.trees(dups)
+
+        assert [(kind, dirs) for kind, dirs, *_ in units] == [
+            ("contained", [str(temp_tree / "album"), str(temp_tree / "all")]),
+        ]
+
+    def test_tree_resolved_with_one_answer(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._album(temp_tree / "album")
+        self._album(temp_tree / "copy")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        inputs = iter(["0"])
+        monkeypatch.setattr("builtins.input", lambda _: next(inputs))
+
+        removed, left = processor.press.squeeze_trees(processor.trees(dups), dups)
+
+        assert removed == sorted(
+            [
+                str(temp_tree / "copy" / "x.jpg"),
+                str(temp_tree / "copy" / "sub" / "y.jpg"),
+            ]
+        )
+        assert left == {}
+
+    def test_ignored_tree_not_offered(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.rerun = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._album(temp_tree / "album")
+        self._album(temp_tree / "keep")
+        ctx.appraiser_rules_filename.write_text("")
+        ctx.appraiser_ignore_filename.write_text(f"=:{temp_tree / 'keep'}\n")
+
+        processor = Processor([str(temp_tree)])
+        files, dups = processor.calculus()
+
+        def prompt(_):
+            raise AssertionError("ignored tree offered")
+
+        monkeypatch.setattr("builtins.input", prompt)
+
+        removed, left = processor.press.squeeze_trees(processor.trees(dups), dups)
+
+        assert removed == []
+        assert left == dups
+
+
+class TestParallelHashing:
+    def test_jobs_find_same_duplicates(self, temp_tree, reset_ctx, working_dir):
+        """Parallel hashing gives the same groups as a single worker."""
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.large_file_threshold = 50
+        reset_ctx.partial_hash_size = 10
+
+        for i in range(12):
+            (temp_tree / f"small{i}.txt").write_bytes(f"group {i % 4}".encode())
+        (temp_tree / "large1.txt").write_bytes(b"L" * 100)
+        (temp_tree / "large2.txt").write_bytes(b"L" * 100)
+
+        reset_ctx.jobs = 1
+        _, serial = Processor([str(temp_tree)]).calculus()
+        reset_ctx.jobs = 4
+        _, parallel = Processor([str(temp_tree)]).calculus()
+
+        assert len(parallel) == 5
+        assert {h: sorted(f) for h, f in parallel.items()} == {
+            h: sorted(f) for h, f in serial.items()
+        }
+
+
+class TestStreaming:
+    def _tree(self, temp_tree):
+        sub = temp_tree / "sub"
+        sub.mkdir()
+        for i in range(6):
+            (temp_tree / f"a{i}.txt").write_bytes(f"group {i % 3}".encode())
+            (sub / f"unique{i}.txt").write_bytes(b"u" * (20 + i))
+        (sub / "copy.txt").write_bytes(b"group 0")
+
+    def test_stream_finds_same_duplicates(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        self._tree(temp_tree)
+
+        all_files, expected = Processor([str(temp_tree)]).calculus()
+        reset_ctx.stream = True
+        reset_ctx.stream_batch = 2
+        files, dups = Processor([str(temp_tree)]).calculus()
+
+        assert {h: sorted(f) for h, f in dups.items()} == {
+            h: sorted(f) for h, f in expected.items()
+        }
+        # only files of duplicate groups are kept
+        assert len(files) == 7 < len(all_files)
+
+    def test_stream_writes_digests_back(
+        self, temp_tree, reset_ctx, working_dir, monkeypatch
+    ):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.stream = True
+        self._tree(temp_tree)
+
+        _, dups1 = Processor([str(temp_tree)]).calculus()
+
+        from dedup.reader import FileReader
+
+        def fail(*args):
+            raise AssertionError("digests should come from the cache")
+
+        monkeypatch.setattr(FileReader, "digest", staticmethod(fail))
+        _, dups2 = Processor([str(temp_tree)]).calculus()
+
+        assert len(dups2) == 3
+        assert dups1 == dups2
+
+    def test_stream_skips_index_collisions(
+        self, temp_tree, tmp_path, reset_ctx, working_dir, monkeypatch
+    ):
+        """Size index batches already hold colliding sizes only."""
+        from dedup.index import Index
+
+        reset_ctx.index_path = tmp_path / "index.db"
+        reset_ctx.dry_run = False
+        reset_ctx.stream = True
+        reset_ctx.stream_batch = 2
+        self._tree(temp_tree)
+
+        def fail(*args):
+            raise AssertionError("central size query in stream mode")
+
+        monkeypatch.setattr(Index, "size_groups", fail)
+        monkeypatch.setattr(Index, "digest_groups", fail)
+        _, dups = Processor([str(temp_tree)]).calculus()
+
+        assert len(dups) == 3
+
+
+class TestExternalGrouping:
+    def test_spilling_gives_same_duplicates(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 4
+
+        for i in range(40):
+            (temp_tree / f"f{i:02}.txt").write_bytes(f"size {i % 5} {i % 3}".encode())
+
+        _, in_memory = Processor([str(temp_tree)]).calculus()
+        reset_ctx.group_memory = 1000
+        _, external = Processor([str(temp_tree)]).calculus()
+
+        assert len(in_memory) == 15
+        assert list(external.items()) == list(in_memory.items())
+
+
+class TestColumnarGrouping:
+    def test_columnar_gives_same_duplicates(self, temp_tree, reset_ctx, working_dir):
+        pytest.importorskip("numpy")
+        reset_ctx.dry_run = True
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.head_hash_size = 4
+
+        for i in range(40):
+            (temp_tree / f"f{i:02}.txt").write_bytes(f"size {i % 5} {i % 3}".encode())
+        # links of one inode only are no duplicates
+        (temp_tree / "alone.bin").write_bytes(b"a different size")
+        os.link(temp_tree / "alone.bin", temp_tree / "alone-link.bin")
+        os.link(temp_tree / "f00.txt", temp_tree / "f00-link.txt")
+
+        files, expected = Processor([str(temp_tree)]).calculus()
+        reset_ctx.columnar = True
+        _, dups = Processor([str(temp_tree)]).calculus()
+
+        assert len(expected) == 15
+        assert list(dups.items()) == list(expected.items())
+        assert Processor([str(temp_tree)]).reclaimable(files, dups) == (
+            Processor([str(temp_tree)]).reclaimable(files, expected)
+        )
+
 
 class TestClearCache:
     def test_clear_hash_cache(self, temp_tree, reset_ctx, working_dir):
@@ -1,5 +1,31 @@
+import errno
+import hashlib
+import os
+import threading
+import time
+import zlib
+
+from pathlib import Path
+
+import pytest
+
 from dedup import cache
-from dedup.reader import FileReader
+from dedup.context import ctx
+from dedup import index
+from dedup.index import Index
+from dedup import hasher
+from dedup.hasher import HashPool
+from dedup import reader
+from dedup.reader import File, FileReader
+from dedup.appraiser import Appraiser, Matcher, Rules
+from dedup import colander
+from dedup.colander import Press
+from dedup.journal import Journal, journal, replay
+from dedup.paths import files as paths
+from dedup.paths import DirectoryTable, PathTable
+from dedup import spill
+from dedup.spill import Grouper
+from dedup.verifier import identical
 from dedup.walker import Walker
 
 
@@ -32,6 +58,126 @@ class TestCache:
         cache.clear(str(temp_tree))
         assert not cache_path.exists()
 
+    def test_file_records_pickled_compactly(self, temp_tree, reset_ctx):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        test_file = temp_tree / "file1.txt"
+        test_file.write_bytes(b"content")
+
+        file_obj = File(str(test_file), str(temp_tree))
+        file_obj.ensure_hash()
+        dir_cache = cache.new(str(temp_tree))
+        dir_cache[file_obj.filename] = file_obj
+        dir_cache.store()
+
+        [loaded] = cache.load(str(temp_tree)).items()
+
+        assert not hasattr(file_obj, "__dict__")
+        assert loaded[0] == str(test_file)
+        assert loaded[1].directory == str(temp_tree)
+        assert loaded[1].parent == file_obj.parent
+        assert (loaded[1].size, loaded[1].hash) == (7, file_obj.hash)
+        for i in range(3):
+            other = File(str(temp_tree / f"other{i}.txt"), str(temp_tree))
+            dir_cache[other.filename] = other
+        dir_cache.store()
+        raw = (temp_tree / reset_ctx.cache_filename).read_bytes()
+        # cache path plus one shared directory string, not one per file
+        assert raw.count(str(temp_tree).encode()) == 2
+
+    def test_write_back_stores_touched_directories(self, temp_tree, reset_ctx):
+        reset_ctx.dry_run = False
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        reset_ctx.cache_flush_interval = 0
+
+        dir_cache = cache.new(str(temp_tree))
+        dir_cache.add("file1.txt", {"hash": "abc123"})
+        write_back = cache.WriteBack({str(temp_tree): dir_cache})
+
+        write_back.touch(str(temp_tree))
+
+        assert cache.load(str(temp_tree))["file1.txt"]["hash"] == "abc123"
+
+
+class TestIndex:
+    def test_opened_once_by_concurrent_threads(self, tmp_path, reset_ctx, monkeypatch):
+        reset_ctx.index_path = tmp_path / "index.db"
+        opened = []
+
+        class SlowIndex(Index):
+            def __init__(self, path):
+                opened.append(path)
+                time.sleep(0.01)
+                super().__init__(path)
+
+        monkeypatch.setattr(index, "Index", SlowIndex)
+        barrier = threading.Barrier(8)
+        found = []
+
+        def open_index():
+            barrier.wait()
+            found.append(index.get())
+
+        threads = [threading.Thread(target=open_index) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(opened) == 1
+        assert all(idx is found[0] for idx in found)
+
+    def test_replace_directory_drops_vanished_files(self, tmp_path, reset_ctx):
+        idx = Index(str(tmp_path / "index.db"))
+        idx.replace_directory(
+            "/r/a", [("/r/a/1", 1, 1, 1, 10, 0, None, None, None, None)]
+        )
+        idx.replace_directory(
+            "/r/a", [("/r/a/2", 1, 2, 1, 10, 0, None, None, None, None)]
+        )
+
+        assert [row[0] for row in idx.directory("/r/a")] == ["/r/a/2"]
+
+    def test_collisions_limited_to_roots(self, tmp_path, reset_ctx):
+        idx = Index(str(tmp_path / "index.db"))
+        idx.replace_directory(
+            "/r/a",
+            [
+                ("/r/a/1", 1, 1, 1, 10, 0, None, "h", "s", "x"),
+                ("/r/a/2", 1, 2, 1, 10, 0, None, "h", "s", "x"),
+                ("/r/a/3", 1, 3, 1, 20, 0, None, None, None, None),
+            ],
+        )
+        idx.replace_directory(
+            "/r/ab", [("/r/ab/4", 1, 4, 1, 20, 0, None, "h", "s", "x")]
+        )
+
+        assert idx.size_groups(["/r/a"], "md5") == [(10, ["/r/a/1", "/r/a/2"])]
+        assert idx.size_groups(["/r"], "md5") == [
+            (10, ["/r/a/1", "/r/a/2"]),
+            (20, ["/r/a/3", "/r/ab/4"]),
+        ]
+
+    def test_digest_groups_of_fully_hashed_sizes(self, tmp_path, reset_ctx):
+        idx = Index(str(tmp_path / "index.db"))
+        idx.replace_directory(
+            "/r",
+            [
+                ("/r/1", 1, 1, 1, 10, 0, None, None, None, "md5:x"),
+                ("/r/2", 1, 2, 1, 10, 0, None, None, None, "md5:x"),
+                ("/r/3", 1, 3, 1, 10, 0, None, None, None, "md5:y"),
+                ("/r/4", 1, 4, 1, 20, 0, None, None, None, "md5:z"),
+                ("/r/5", 1, 5, 1, 20, 0, None, None, None, "md5:z"),
+                ("/r/6", 1, 6, 1, 20, 0, None, None, None, None),
+                ("/r/7", 1, 7, 1, 30, 0, None, None, None, "sha1:w"),
+                ("/r/8", 1, 8, 1, 30, 0, None, None, None, "sha1:w"),
+            ],
+        )
+
+        assert idx.digest_groups(["/r"], "md5") == [("md5:x", ["/r/1", "/r/2"])]
+        # a file without the digest may still match, the size is sieved
+        assert [size for size, _ in idx.size_groups(["/r"], "md5")] == [20, 30]
+
 
 class TestFileReader:
     def test_hash_file(self, temp_tree):
@@ -55,6 +201,544 @@ class TestFileReader:
 
         assert hash1 != hash2
 
+    def test_stage_digests(self, temp_tree, reset_ctx):
+        reset_ctx.head_hash_size = 8
+        test_file = temp_tree / "test.bin"
+        test_file.write_bytes(b"head....middle..tail....")
+
+        head = FileReader.digest(str(test_file), "head")
+        sample = FileReader.digest(str(test_file), "sample")
+        full = FileReader.digest(str(test_file), "full")
+
+        assert len({head, sample, full}) == 3
+        assert full == "md5:" + FileReader.hash(str(test_file))
+
+    def test_algorithms_tag_digests(self, temp_tree, reset_ctx):
+        test_file = temp_tree / "test.bin"
+        content = b"tagged content"
+        test_file.write_bytes(content)
+
+        reset_ctx.hash_algo = "sha256"
+        reset_ctx.filter_algo = "crc32"
+
+        assert FileReader.digest(str(test_file), "full") == (
+            "sha256:" + hashlib.sha256(content).hexdigest()
+        )
+        assert FileReader.digest(str(test_file), "head") == (
+            "crc32:%08x" % zlib.crc32(content)
+        )
+
+    def test_fast_algorithms_only_filter(self):
+        from click.testing import CliRunner
+        from dedup.main import cli
+
+        assert "crc32" not in reader.IDENTITY_ALGORITHMS
+        assert set(reader.IDENTITY_ALGORITHMS) <= set(reader.ALGORITHMS)
+        result = CliRunner().invoke(cli, ["--hash", "crc32", "stats"])
+        assert result.exit_code == 2
+        assert "Invalid value for '--hash'" in result.output
+
+    def test_other_algorithm_ignores_stored_digests(self, temp_tree, reset_ctx):
+        test_file = temp_tree / "test.bin"
+        test_file.write_bytes(b"switching algorithms")
+        file_obj = File(str(test_file), str(temp_tree))
+        md5_hash = file_obj.hash
+
+        reset_ctx.hash_algo = "blake2b"
+
+        assert not file_obj.hashed
+        assert file_obj.hash != md5_hash
+        assert file_obj.digest("full").startswith("blake2b:")
+
+    def test_small_file_head_is_full(self, temp_tree, reset_ctx):
+        test_file = temp_tree / "small.txt"
+        test_file.write_bytes(b"fits in the head block")
+        file_obj = File(str(test_file), str(temp_tree))
+
+        file_obj.set_digest("head", FileReader.digest(str(test_file), "head"))
+
+        assert file_obj.hashed
+        assert file_obj.hash == FileReader.hash(str(test_file), full=True)
+
+    def test_readinto_matches_md5_across_chunks(self, temp_tree, reset_ctx):
+        content = os.urandom(3 * FileReader.MAX_CHUNK_SIZE + 123)
+        test_file = temp_tree / "big.bin"
+        test_file.write_bytes(content)
+
+        expected = hashlib.md5(content).hexdigest()
+
+        assert FileReader.hash(str(test_file), full=True) == expected
+        reset_ctx.use_mmap = True
+        reset_ctx.mmap_threshold = 0
+        assert FileReader.hash(str(test_file), full=True) == expected
+
+    def test_gentle_io_advises_and_drops_pages(self, temp_tree, reset_ctx, monkeypatch):
+        test_file = temp_tree / "test.bin"
+        test_file.write_bytes(b"page cache friendly")
+        expected = FileReader.hash(str(test_file), full=True)
+        advice = []
+
+        def record(fd, offset, length, flag):
+            advice.append(flag)
+
+        monkeypatch.setattr(os, "posix_fadvise", record, raising=False)
+        reset_ctx.gentle_io = True
+
+        assert FileReader.hash(str(test_file), full=True) == expected
+        if hasattr(os, "POSIX_FADV_DONTNEED"):
+            assert os.POSIX_FADV_WILLNEED in advice
+            assert advice[-1] == os.POSIX_FADV_DONTNEED
+
+    def test_noatime_falls_back_without_ownership(
+        self, temp_tree, reset_ctx, monkeypatch
+    ):
+        test_file = temp_tree / "test.bin"
+        test_file.write_bytes(b"owned by someone else")
+        expected = FileReader.hash(str(test_file), full=True)
+        os_open = os.open
+
+        def refuse_noatime(path, flags, *args):
+            if reader.NOATIME and flags & reader.NOATIME:
+                raise PermissionError(errno.EPERM, "Operation not permitted")
+            return os_open(path, flags, *args)
+
+        monkeypatch.setattr(os, "open", refuse_noatime)
+        reset_ctx.gentle_io = True
+
+        assert FileReader.hash(str(test_file), full=True) == expected
+
+    def test_sparse_holes_not_read(self, temp_tree, reset_ctx, monkeypatch):
+        size = 3 * FileReader.MAX_CHUNK_SIZE
+        test_file = temp_tree / "sparse.bin"
+        with open(test_file, "wb") as fo:
+            fo.seek(FileReader.MAX_CHUNK_SIZE)
+            fo.write(b"data in the middle")
+            fo.truncate(size)
+        if os.stat(test_file).st_blocks * 512 >= size:
+            pytest.skip("filesystem does not keep holes")
+        expected = hashlib.md5(test_file.read_bytes()).hexdigest()
+        segments = []
+        hash_segment = FileReader._hash_segment
+
+        def recording(fi, m, size, chunk=None):
+            segments.append(size)
+            return hash_segment(fi, m, size, chunk)
+
+        monkeypatch.setattr(FileReader, "_hash_segment", staticmethod(recording))
+
+        assert FileReader.hash(str(test_file), full=True) == expected
+        assert sum(segments) < size
+
+    def test_chunk_size_adapts(self):
+        assert FileReader.chunk_size(10) == FileReader.CHUNK_SIZE
+        assert FileReader.chunk_size(100_000, 4096) == 102_400
+        assert FileReader.chunk_size(10**10, 4096) == FileReader.MAX_CHUNK_SIZE
+        assert FileReader.chunk_size(10**10, 3 * 10**6) == 3 * 10**6
+
+
+def legacy_weight(rules, filepath):
+    weight = 0
+    for rule in rules:
+        if filepath.startswith(rule):
+            weight += rules[rule]
+        if os.path.dirname(filepath) == rule:
+            weight += rules[rule]
+    return weight
+
+
+class TestRules:
+    RULES = {"/a": 1, "/a/b": 2, "/a/bc": 4, "/a/b/c": 8, "/x/y": 16, "/a/b/": 32}
+    PATHS = ["/a/b/c/f.jpg", "/a/bcd/f.jpg", "/a/b/f.jpg", "/x/f.jpg", "/a"]
+
+    def test_matches_startswith_semantics(self):
+        rules = Rules()
+        for rule, weight in self.RULES.items():
+            rules[rule] = weight
+
+        for path in self.PATHS:
+            assert rules.weight(path) == legacy_weight(self.RULES, path), path
+
+    def test_incremental_changes(self):
+        rules = Rules()
+        rules["/a/b"] += 1
+        rules["/a/b"] += 1
+        rules["/a/bc"] += 1
+        assert rules.weight("/a/bc/f") == 4
+        del rules["/a/bc"]
+        assert rules.weight("/a/bc/f") == 2
+        assert rules["/missing"] == 0
+        assert "/missing" not in rules
+
+
+def legacy_ignored(ignore, file):
+    while file:
+        if file in ignore["="]:
+            return True
+        for pat in ignore["~"]:
+            if pat in file:
+                return True
+        dirname = os.path.dirname(file)
+        if file == dirname:
+            return False
+        file = dirname
+    return False
+
+
+class TestMatcher:
+    IGNORE = {"=": {"/pics/keep", "/docs"}, "~": {"print", "a.b", "(1)"}}
+    PATHS = [
+        "/pics/keep/x.jpg",
+        "/pics/keeper/x.jpg",
+        "/docs",
+        "/pics/to_print/x.jpg",
+        "/pics/axb/x.jpg",
+        "/pics/a.b/x.jpg",
+        "/pics/copy (1).jpg",
+        "/pics/other/x.jpg",
+        "relative/x.jpg",
+    ]
+
+    def test_matches_ancestor_loop(self):
+        matcher = Matcher(self.IGNORE["="], self.IGNORE["~"])
+
+        for path in self.PATHS:
+            expected = legacy_ignored(self.IGNORE, path)
+            assert (matcher.under(path) or matcher.contains(path)) == expected, path
+
+    def test_compiled_on_reload(self, tmp_path, reset_ctx, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        reset_ctx.rerun = True
+        ctx.appraiser_rules_filename.write_text("1:/pics\n")
+        ctx.appraiser_ignore_filename.write_text("=:/pics/keep\n~:print\n")
+        ctx.appraiser_remove_filename.write_text("d:/tmp/junk\n~:.bak\nf:Thumbs.db\n")
+        appraiser = Appraiser()
+
+        assert appraiser.is_ignored("/pics/keep/a/b.jpg")
+        assert appraiser.is_ignored("/x/printed.jpg")
+        assert not appraiser.is_ignored("/pics/keeper.jpg")
+        assert appraiser.in_remove("/tmp/junk", "/tmp/junk/a.jpg")
+        assert appraiser.in_remove("/x", "/x/a.jpg.bak")
+        assert appraiser.in_remove("/x", "/x/Thumbs.db")
+        assert not appraiser.in_remove("/x", "/x/a.jpg")
+
+
+class TestJournal:
+    def test_torn_line_skipped(self, tmp_path):
+        path = tmp_path / "state.journal"
+        writer = Journal()
+        writer.append(path, "1:/a")
+        writer.append(path, "2:/a")
+        writer.close()
+        with path.open("a") as fo:
+            fo.write("3:/b")  # crash in the middle of a write
+
+        assert list(replay(path)) == ["1:/a", "2:/a"]
+        assert list(replay(tmp_path / "missing")) == []
+
+    def test_rules_replayed_and_compacted(self, tmp_path, reset_ctx, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        reset_ctx.rerun = True
+        ctx.appraiser_rules_filename.write_text("1:/pics\n")
+        appraiser = Appraiser()
+        appraiser.add_from_file(paths.intern("/docs/a.txt"))
+        appraiser.add_from_file(paths.intern("/docs/b.txt"))
+        journal.sync()
+        # a session killed here left only the journal behind
+        assert ctx.appraiser_rules_filename.read_text() == "1:/pics\n"
+
+        assert Appraiser()._rules == {"/pics": 1, "/docs": 2}
+
+        appraiser.compact_rules()
+        journal.close()
+        assert not ctx.rules_journal_filename.exists()
+        assert ctx.appraiser_rules_filename.read_text() == "1:/pics\n2:/docs\n"
+        assert Appraiser()._rules == {"/pics": 1, "/docs": 2}
+
+    def test_synced_before_prompt(self, tmp_path, reset_ctx, monkeypatch):
+        reset_ctx.journal_sync_interval = 60
+        path = tmp_path / "answers.list"
+        journal.sync()
+        journal.append(path, "/kept")
+        # what a kill at the prompt leaves on disk
+        monkeypatch.setattr("builtins.input", lambda _: path.read_text())
+
+        assert colander._ask("select>") == "/kept\n"
+        journal.close()
+
+    def test_reload_counts_journal_once(self, tmp_path, reset_ctx, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        reset_ctx.rerun = True
+        ctx.rules_journal_filename.write_text("1:/a\n2:/a\n")
+        appraiser = Appraiser()
+        appraiser.reload_rules()
+        appraiser.reload_rules()
+
+        assert appraiser._journaled == 2
+
+    def test_stale_journal_kept_by_read_only_commands(
+        self, tmp_path, reset_ctx, monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        ctx.rules_journal_filename.write_text("5:/crashed\n")
+
+        press = Press()
+        assert ctx.rules_journal_filename.exists()
+        assert press.appraiser._rules == {}
+
+
+class TestPaths:
+    def test_directory_resolved_once(self, temp_tree, monkeypatch):
+        real = temp_tree / "real"
+        real.mkdir()
+        (temp_tree / "link").symlink_to(real)
+        resolved = real.resolve()
+        table = PathTable(DirectoryTable())
+        calls = []
+        resolve = Path.resolve
+
+        def counting(self, *args, **kwargs):
+            calls.append(self)
+            return resolve(self, *args, **kwargs)
+
+        monkeypatch.setattr(Path, "resolve", counting)
+        ids = [table.intern(str(temp_tree / "link" / f"f{i}")) for i in range(50)]
+
+        assert len(set(ids)) == 50
+        assert table.intern(str(temp_tree / "link" / "f0")) == ids[0]
+        assert [table.absolute(i) for i in ids[:2]] == [
+            str(resolved / "f0"),
+            str(resolved / "f1"),
+        ]
+        assert table.directory(ids[49]) == str(resolved)
+        assert len(calls) == 1
+
+    def test_relative_paths_follow_cwd(self, temp_tree, monkeypatch):
+        table = PathTable(DirectoryTable())
+        monkeypatch.chdir(temp_tree)
+        here = table.intern("file.txt")
+        (temp_tree / "sub").mkdir()
+        monkeypatch.chdir(temp_tree / "sub")
+        there = table.intern("file.txt")
+
+        assert here != there
+        assert table.absolute(there) == str((temp_tree / "sub").resolve() / "file.txt")
+
+
+class TestVerifier:
+    def test_splits_on_first_difference(self, temp_tree, reset_ctx):
+        size = 3 * FileReader.CHUNK_SIZE
+        contents = {
+            "a": b"x" * size,
+            "b": b"x" * size,
+            "c": b"y" + b"x" * (size - 1),
+            "d": b"x" * (size - 1) + b"y",
+            "e": b"x" * (size - 1) + b"y",
+        }
+        files = []
+        for name, content in contents.items():
+            (temp_tree / name).write_bytes(content)
+            files.append(File(str(temp_tree / name), str(temp_tree)))
+
+        groups = identical(files)
+
+        assert sorted(sorted(f.name for f in g) for g in groups) == [
+            ["a", "b"],
+            ["d", "e"],
+        ]
+
+    def test_unreadable_file_is_dropped(self, temp_tree, reset_ctx):
+        for name in ("a", "b"):
+            (temp_tree / name).write_bytes(b"same")
+        files = [File(str(temp_tree / n), str(temp_tree)) for n in ("a", "b")]
+        files[1].ensure_stat()
+        (temp_tree / "b").unlink()
+
+        assert identical(files) == []
+
+
+class TestGrouper:
+    RECORDS = [(size % 7, f"path{size:03}") for size in range(100)] + [(99, "single")]
+
+    def _groups(self, budget):
+        grouper = Grouper(budget)
+        for key, item in self.RECORDS:
+            grouper.add(key, item)
+        spilled = len(grouper._runs)
+        return list(grouper.groups()), spilled
+
+    def test_spilled_runs_give_same_groups(self, reset_ctx):
+        in_memory, spilled = self._groups(10**9)
+        assert spilled == 0
+        external, spilled = self._groups(2000)
+        assert spilled > 1
+
+        assert external == in_memory
+        assert [key for key, _ in in_memory] == list(range(7))
+        assert all(items == sorted(items) for _, items in in_memory)
+
+    def test_runs_merged_past_fan_in(self, reset_ctx, monkeypatch):
+        monkeypatch.setattr(spill, "FAN_IN", 3)
+        in_memory, _ = self._groups(10**9)
+        external, spilled = self._groups(1)
+
+        assert spilled <= 3
+        assert external == in_memory
+
+
+class TestColumns:
+    def test_digest_groups_match_grouper(self, reset_ctx):
+        pytest.importorskip("numpy")
+        from dedup.columns import digest_groups
+
+        records = [(n % 3, f"md5:{n % 2}", n) for n in range(12)] + [(5, "md5:x", 0)]
+        grouper = Grouper(10**9)
+        for number, digest, position in records:
+            grouper.add((number, digest), position)
+
+        assert list(digest_groups(*zip(*records))) == list(grouper.groups())
+
+
+class TestHashPool:
+    def test_threads_match_serial(self, temp_tree, reset_ctx):
+        files = []
+        for i in range(10):
+            path = temp_tree / f"file{i}.txt"
+            path.write_bytes(f"content {i % 3}".encode())
+            files.append(File(str(path), str(temp_tree)))
+
+        with HashPool(jobs=4) as pool:
+            results = list(pool.hash_files(files))
+
+        assert all(error is None for _, error in results)
+        assert [f.digest("full") for f in files] == [
+            "md5:" + FileReader.hash(f.filename) for f in files
+        ]
+
+    def test_process_pool_fills_files(self, temp_tree, reset_ctx):
+        test_file = temp_tree / "test.txt"
+        test_file.write_bytes(b"process pool content")
+        file_obj = File(str(test_file), str(temp_tree))
+
+        with HashPool(jobs=2, kind="process") as pool:
+            results = list(pool.hash_files([file_obj]))
+
+        assert results == [(file_obj, None)]
+        assert file_obj.hash == FileReader.hash(str(test_file))
+
+    @pytest.mark.parametrize("kind", ["thread", "process"])
+    def test_compare_groups_in_workers(self, temp_tree, reset_ctx, monkeypatch, kind):
+        groups = []
+        for name, contents in (("a", [b"same", b"same", b"diff"]), ("b", [b"xy"] * 2)):
+            group = []
+            for i, content in enumerate(contents):
+                path = temp_tree / f"{name}{i}.bin"
+                path.write_bytes(content)
+                group.append(File(str(path), str(temp_tree)))
+            groups.append(group)
+        monkeypatch.setattr(hasher, "rotational", lambda dev: True)
+
+        with HashPool(jobs=2, kind=kind) as pool:
+            same = list(pool.compare_groups(groups))
+
+        assert sorted(same, key=lambda g: g[0].filename) == [
+            groups[0][:2],
+            groups[1],
+        ]
+
+    def test_compare_takes_device_slots(self, temp_tree, reset_ctx, monkeypatch):
+        groups = []
+        for i in range(4):
+            for copy in (temp_tree / f"g{i}a.bin", temp_tree / f"g{i}b.bin"):
+                copy.write_bytes(f"group {i}".encode())
+            groups.append(
+                [File(str(temp_tree / f"g{i}{c}.bin"), str(temp_tree)) for c in "ab"]
+            )
+        active = []
+        peak = []
+        lock = threading.Lock()
+        compare_job = hasher._compare_job
+
+        def tracking_job(files):
+            with lock:
+                active.append(files)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(files)
+            return compare_job(files)
+
+        monkeypatch.setattr(hasher, "_compare_job", tracking_job)
+        monkeypatch.setattr(hasher, "rotational", lambda dev: True)
+        with HashPool(jobs=4) as pool:
+            same = list(pool.compare_groups(groups))
+
+        assert max(peak) == 1
+        assert len(same) == 4
+
+    def test_unreadable_file_reports_error(self, temp_tree, reset_ctx):
+        missing = File(str(temp_tree / "missing.txt"), str(temp_tree))
+
+        with HashPool(jobs=2) as pool:
+            [(file_obj, error)] = list(pool.hash_files([missing]))
+
+        assert file_obj is missing
+        assert file_obj.digest("full") is None
+        assert isinstance(error, OSError)
+
+    def _files(self, temp_tree, count):
+        files = []
+        for i in range(count):
+            path = temp_tree / f"file{i}.txt"
+            path.write_bytes(f"content {i}".encode())
+            file_obj = File(str(path), str(temp_tree))
+            file_obj.ensure_stat()
+            files.append(file_obj)
+        return files
+
+    def test_spinning_disk_read_one_at_a_time(self, temp_tree, reset_ctx, monkeypatch):
+        files = self._files(temp_tree, 8)
+        active = []
+        peak = []
+        lock = threading.Lock()
+        hash_job = hasher._hash_job
+
+        def tracking_job(filename, stage):
+            with lock:
+                active.append(filename)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(filename)
+            return hash_job(filename, stage)
+
+        monkeypatch.setattr(hasher, "_hash_job", tracking_job)
+        monkeypatch.setattr(hasher, "rotational", lambda dev: True)
+        with HashPool(jobs=4) as pool:
+            results = list(pool.hash_files(files))
+
+        assert max(peak) == 1
+        assert all(error is None for _, error in results)
+        assert all(f.hashed for f in files)
+
+    def test_rotational_device_keeps_a_slot(self, temp_tree, reset_ctx, monkeypatch):
+        files = self._files(temp_tree, 3)
+        reset_ctx.rotational_jobs = 0
+        monkeypatch.setattr(hasher, "rotational", lambda dev: True)
+
+        with HashPool(jobs=4) as pool:
+            results = list(pool.hash_files(files))
+
+        assert len(results) == 3
+        assert all(f.hashed for f in files)
+
+    def test_device_queue_in_inode_order(self, temp_tree, reset_ctx):
+        files = self._files(temp_tree, 5)
+
+        with HashPool(jobs=1) as pool:
+            hashed = [file_obj for file_obj, _ in pool.hash_files(files[::-1])]
+
+        assert hashed == sorted(files, key=lambda f: f.ino)
+
 
 class TestWalker:
     def test_walk_directory(self, temp_tree, reset_ctx, working_dir):
@@ -80,3 +764,55 @@ class TestWalker:
         files, directories = walker.build(str(temp_tree))
 
         assert len(files) == 0
+
+    def test_hidden_trees_pruned(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.cache_filename = ".test-cache.cpl"
+
+        hidden = temp_tree / ".git" / "objects"
+        hidden.mkdir(parents=True)
+        (hidden / "blob").write_bytes(b"hidden")
+        (temp_tree / ".test-cache.cpl.tmp").write_bytes(b"partial cache")
+        (temp_tree / ".profile").write_bytes(b"dot file")
+        (temp_tree / "link").symlink_to(temp_tree / ".profile")
+
+        walker = Walker()
+        files, directories = walker.build(str(temp_tree))
+
+        assert sorted(os.path.basename(f) for f in files) == [".profile"]
+        assert list(directories) == [str(temp_tree.resolve())]
+        assert list(walker.directories(str(temp_tree))) == [str(temp_tree.resolve())]
+
+    def test_files_keep_entry_stat(self, temp_tree, reset_ctx, working_dir):
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        (temp_tree / "file1.txt").write_bytes(b"content1")
+
+        files, _ = Walker().build(str(temp_tree))
+
+        [file_obj] = files.values()
+        assert file_obj.mtime_ns is not None
+        assert file_obj.size == 8
+
+    def test_parallel_walk_matches_sequential(self, tmp_path, reset_ctx, working_dir):
+        reset_ctx.cache_filename = ".test-cache.cpl"
+        roots = []
+        for r in range(2):
+            root = tmp_path / f"root{r}"
+            for d in range(4):
+                nested = root / f"d{d}" / "inner"
+                nested.mkdir(parents=True)
+                (nested / "file.txt").write_bytes(f"{r}{d}".encode())
+                (root / f"d{d}" / "top.txt").write_bytes(b"top")
+            roots.append(str(root))
+
+        walker = Walker()
+        files1, directories1 = walker.build_all(roots)
+        progress1 = sorted(reset_ctx.progress_filename.read_text().splitlines())
+
+        reset_ctx.walk_jobs = 4
+        files2, directories2 = walker.build_all(roots)
+        progress2 = sorted(reset_ctx.progress_filename.read_text().splitlines())
+
+        assert len(files1) == 16
+        assert list(files2) == list(files1)
+        assert list(directories2) == list(directories1)
+        assert progress2 == progress1